@@ -1,4 +1,5 @@
 import errno
+import hashlib
 import os
 import datetime
 
@@ -8,6 +9,52 @@ import seaborn as sns
 import numpy as np
 import pickle
 import gzip
+import json
+from typing import Iterable
+
+from bitmap import BitmapIndex
+from download import Batch
+from instrument import span, timed
+
+# suffix of file with already converted DataFrame
+_frame_cache_suffix = ".df.pkl"
+# suffix of file with bitmap index of converted DataFrame
+_bitmap_cache_suffix = ".bitmap.pkl"
+
+# bins of damage (p53) and accident cause (p12)
+_cost_bins = [0, 500, 2000, 5000, 10000, 1000000]
+_cost_labels = ('< 50', '50 - 200', '200 - 500', '500 - 1000', '> 1000')
+_cause_bins = [0, 200, 300, 400, 500, 600, 700]
+_cause_labels = ('nezaviněná řidičem', 'nepřiměřená rychlost jízdy', 'nesprávné předjíždění', 'nedání přednosti v jízdě',
+                 'nesprávný způsob jízdy', 'technická závada vozidla')
+
+# names of surface states (p16)
+_surface_names = {
+    0: 'jiný',
+    1: 'suchý neznečištěný',
+    2: 'suchý znečištěný',
+    3: 'mokrý',
+    4: 'bláto',
+    5: 'náledí, ujetý sníh - posypané',
+    6: 'náledí, ujetý sníh - neposypané',
+    7: 'rozlitý olej, nafta apod.',
+    8: 'souvislý sníh',
+    9: 'náhlá změna stavu',
+}
+
+# dimensions of aggregate cube
+_cube_dimensions = ['region', 'month', 'p12', 'p53', 'p16']
+# columns needed by make_cube and their names in batches of DataDownloader.iter_batches
+_cube_batch_columns = {
+    'region': 'Kraj',
+    'p2a': 'Datum nehody',
+    'p12': 'Hlavní příčina nehody',
+    'p13a': 'Usmrceno osob',
+    'p13b': 'Těžce zraněno osob',
+    'p13c': 'Lehce zraněno osob',
+    'p16': 'Stav povrchu v době nehody',
+    'p53': 'Škoda na vozidle (stovky kč)',
+}
 
 
 def _save_and_show(fig_location: str, show_figure: bool):
@@ -25,82 +72,294 @@ def _save_and_show(fig_location: str, show_figure: bool):
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
-        plt.savefig(fig_location, dpi=200)
+        with span("savefig"):
+            plt.savefig(fig_location, dpi=200)
 
     if show_figure:
         plt.show()
 
 
-def get_dataframe(filename: str = "accidents.pkl.gz", verbose: bool = False) -> pd.DataFrame:
+def _smallest_dtype(series: pd.Series, category_ratio: float):
+    """
+    Picks smallest type able to hold all values of series without loss
+    :param series: column to check
+    :param category_ratio: maximum ratio of unique values to rows for conversion into category
+    :return: new type, or None if type should be kept
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_datetime64_any_dtype(dtype) \
+            or pd.api.types.is_bool_dtype(dtype):
+        return None
+
+    if pd.api.types.is_integer_dtype(dtype):
+        if len(series) == 0:
+            return None
+        low, high = series.min(), series.max()
+        for candidate in ('int8', 'int16', 'int32', 'int64'):
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return candidate if candidate != dtype else None
+        return None
+
+    if pd.api.types.is_float_dtype(dtype):
+        if dtype == np.float32:
+            return None
+        values = series.to_numpy()
+        # only if every value survives the round trip
+        if np.array_equal(values.astype(np.float32).astype(values.dtype), values, equal_nan=True):
+            return 'float32'
+        return None
+
+    if len(series) > 0 and series.nunique(dropna=False) / len(series) <= category_ratio:
+        return 'category'
+    return None
+
+
+@timed("analysis.optimize_dtypes")
+def optimize_dtypes(df: pd.DataFrame, overrides: dict = None, category_ratio: float = 0.5) -> tuple:
+    """
+    Converts every column into smallest type able to hold its observed values
+    :param df: data source, converted in place
+    :param overrides: mapping of column names to types, used instead of automatic choice
+    :param category_ratio: maximum ratio of unique values to rows for conversion into category
+    :return: converted data and memory report with type and size of every column before and after conversion
+    """
+    overrides = overrides if overrides is not None else {}
+    report = {}
+
+    for col in df.columns:
+        before = df[col].memory_usage(deep=True, index=False)
+        dtype_before = str(df[col].dtype)
+
+        dtype = overrides[col] if col in overrides else _smallest_dtype(df[col], category_ratio)
+        if dtype is not None:
+            df[col] = df[col].astype(dtype)
+
+        report[col] = {
+            "dtype_before": dtype_before,
+            "dtype_after": str(df[col].dtype),
+            "bytes_before": int(before),
+            "bytes_after": int(df[col].memory_usage(deep=True, index=False)),
+        }
+
+    return df, report
+
+
+def _save_cache(cache_filename: str, value):
+    """
+    Pickles value into cache file next to input data, if file can't be written (e.g. read-only folder) nothing is saved
+    :param cache_filename: file to save to
+    :param value: value to save
+    """
+    # temporary file is unique, so concurrent processes don't overwrite each other
+    tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, 'wb') as cache_file:
+            pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+@timed("analysis.get_dataframe")
+def get_dataframe(filename: str = "accidents.pkl.gz", verbose: bool = False, cache: bool = True,
+                  overrides: dict = None, report_file: str = None) -> pd.DataFrame:
     """
     Parses data from given file into pandas DataFrame
     :param filename: path to file with input data
     :param verbose: if true, prints data size diffs
+    :param cache: if true, converted data is stored next to input file and reused while input file is unchanged
+    :param overrides: mapping of column names to types, used instead of automatic choice
+    :param report_file: file to save memory report of every column to, as json
     :return: parsed data
     """
-    file = gzip.open(filename)
-    data = pickle.load(file)
-    df = pd.DataFrame(data)
-
-    # print old sizes
-    if verbose:
-        size = 0
-        for col in df.columns:
-            size += df[col].memory_usage(deep=True, index=False)
-        print(f"old_size={size / 1024 / 1024:.1f} MB")
-
-    # date convert
-    df['p2a'] = df['p2a'].astype('datetime64')
-    df.rename({'p2a': 'date'})
-
-    # convert rest
-    # got these by printing unique value count
-    cols_to_convert = ['p', 'q', 'k', 'j', 'p36', 'weekday(p2a)', 'p6', 't', 'p2b', 'o', 'l', 'r', 'p37']
-    for col in cols_to_convert:
-        df[col] = df[col].astype('category')
-
-    # if all unique value can fit into -128..=127, why not compress them
-    cols_to_i8 = ['p5a', 'p58', 'p55a', 'p57', 'p7', 'p8', 'p9', 'p10', 'p11', 'p13a', 'p13b', 'p13c', 'p15', 'p16', 'p17', 'p18', 'p19',
-                  'p20', 'p21', 'p22', 'p23', 'p24', 'p27', 'p28', 'p34', 'p35', 'p39', 'p44', 'p45a', 'p47', 'p48a', 'p49', 'p50a', 'p50b',
-                  'p51', 'p52']
-    for col in cols_to_i8:
-        df[col] = df[col].astype('int8')
-
-    # print new sizes
+    cache_filename = filename + _frame_cache_suffix
+    stat = os.stat(filename)
+    # overrides change the result, so they are part of cache key
+    source = [stat.st_size, stat.st_mtime_ns, sorted((str(k), str(v)) for k, v in (overrides or {}).items())]
+
+    df = None
+    if cache and os.path.isfile(cache_filename):
+        with open(cache_filename, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if len(cached) == 3 and cached[0] == source:
+            _, df, report = cached
+
+    if df is None:
+        with span("analysis.load_pickle"):
+            file = gzip.open(filename)
+            data = pickle.load(file)
+        df = pd.DataFrame(data)
+
+        # date convert
+        df['p2a'] = df['p2a'].astype('datetime64[ns]')
+        df.rename({'p2a': 'date'})
+
+        # convert rest by observed values
+        df, report = optimize_dtypes(df, overrides)
+
+        if cache:
+            # uncompressed pickle keeps converted types and loads columns as whole blocks
+            _save_cache(cache_filename, (source, df, report))
+
+    # print sizes
     if verbose:
-        size = 0
-        for col in df.columns:
-            size += df[col].memory_usage(deep=True, index=False)
-        print(f"new_size={size / 1024 / 1024:.1f} MB")
+        print(f"old_size={sum(col['bytes_before'] for col in report.values()) / 1024 / 1024:.1f} MB")
+        print(f"new_size={sum(col['bytes_after'] for col in report.values()) / 1024 / 1024:.1f} MB")
+
+    if report_file is not None:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
 
     return df
 
 
+def _rows_digest(df: pd.DataFrame, columns: Iterable[str]) -> str:
+    """
+    Returns hash of values of given columns, independent of chosen integer types
+    :param df: hashed rows
+    :param columns: hashed columns
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for name in columns:
+        column = df[name]
+        if pd.api.types.is_integer_dtype(column.dtype):
+            column = column.astype('i8')
+        digest.update(pd.util.hash_pandas_object(column, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_bitmap_index(filename: str = "accidents.pkl.gz", df: pd.DataFrame = None,
+                     columns: list = None) -> BitmapIndex:
+    """
+    Returns bitmap index of data in given file, index is stored next to input file and reused while it is unchanged.
+    If rows were only appended to the file, stored index is extended by them instead of being built again
+    :param filename: path to file with input data
+    :param df: data made by get_dataframe from the same file. If its None, get_dataframe is called when index is built
+    :param columns: columns to index. If its None, int8 and category columns with few values are used
+    :return: index with rows in order of get_dataframe
+    """
+    index_filename = filename + _bitmap_cache_suffix
+    stat = os.stat(filename)
+    source = [stat.st_size, stat.st_mtime_ns, sorted(columns) if columns is not None else None]
+
+    cached = None
+    if os.path.isfile(index_filename):
+        with open(index_filename, 'rb') as index_file:
+            cached = pickle.load(index_file)
+        if len(cached) != 3 or cached[0][2] != source[2]:
+            cached = None
+        elif cached[0] == source:
+            return cached[1]
+
+    if df is None:
+        df = get_dataframe(filename)
+
+    index = None
+    if cached is not None:
+        _, index, digest = cached
+        # indexed rows must be unchanged, otherwise their bitmaps are wrong
+        if len(df) < index.n_rows or _rows_digest(df.iloc[:index.n_rows], index.columns) != digest:
+            index = None
+    if index is not None:
+        with span("analysis.append_bitmap_index", len(df) - index.n_rows):
+            index.append(df.iloc[index.n_rows:])
+    else:
+        index = BitmapIndex.build(df, columns)
+
+    _save_cache(index_filename, (source, index, _rows_digest(df, index.columns)))
+    return index
+
+
+@timed("analysis.make_cube")
+def make_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates data into cube of accident counts and casualty sums, shared by all plots
+    Dimensions are region, month, binned cause (p12), binned damage (p53) and surface (p16)
+    :param df: data source
+    :return: cube with one row for every observed combination of dimensions
+    """
+    keys = pd.DataFrame({
+        'region': df['region'],
+        'month': df['p2a'].to_numpy().astype('datetime64[M]').astype('datetime64[ns]'),
+        'p12': pd.cut(df['p12'], bins=_cause_bins, include_lowest=True, labels=_cause_labels),
+        'p53': pd.cut(df['p53'], bins=_cost_bins, include_lowest=True, labels=_cost_labels),
+        'p16': df['p16'],
+        'p13a': df['p13a'].astype('int64'),
+        'p13b': df['p13b'].astype('int64'),
+        'p13c': df['p13c'].astype('int64'),
+    })
+
+    # single grouped pass, rows outside of bins are kept, so counts per region stay complete
+    cube = keys.groupby(_cube_dimensions, observed=True, dropna=False).agg(
+        count=('p13a', 'size'), p13a=('p13a', 'sum'), p13b=('p13b', 'sum'), p13c=('p13c', 'sum'))
+    return cube.reset_index()
+
+
+@timed("analysis.make_cube_batches")
+def make_cube_batches(batches: Iterable[Batch]) -> pd.DataFrame:
+    """
+    Same as make_cube, but aggregates batches yielded by DataDownloader.iter_batches one by one
+    Only cubes of batches are kept, so memory doesn't grow with number of accidents
+    :param batches: batches with all columns in _cube_batch_columns
+    :return: cube with one row for every observed combination of dimensions
+    """
+    cube = None
+    for _region, _month, header, columns in batches:
+        df = pd.DataFrame({name: np.asarray(columns[header.index(column)])
+                           for name, column in _cube_batch_columns.items()})
+        parts = [make_cube(df)] if cube is None else [cube, make_cube(df)]
+        # cubes are summed after every batch, so the result stays small
+        cube = pd.concat(parts, ignore_index=True).groupby(_cube_dimensions, observed=True, dropna=False).sum()
+        cube = cube.reset_index()
+
+    if cube is None:
+        return make_cube(pd.DataFrame({name: [] for name in _cube_batch_columns}).astype({'p2a': 'datetime64[ns]'}))
+    return cube
+
+
+def _as_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns cube made by make_cube, data source can be raw data or already made cube
+    :param df: data source
+    :return: cube
+    """
+    if set(df.columns) == set(_cube_dimensions + ['count', 'p13a', 'p13b', 'p13c']):
+        return df
+    return make_cube(df)
+
+
+@timed("analysis.plot_conseq")
 def plot_conseq(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
     """
     Renders graph of accidents consequences
-    :param df: data source
+    :param df: data source, raw data or cube made by make_cube
     :param fig_location: file to save to
     :param show_figure: show figure on screen
     """
+    cube = _as_cube(df)
+
     fig, ax = plt.subplots(4, 1)
     fig.set_size_inches((8, 10))
     fig.suptitle("Následky nehod podle krajů")
 
-    sums = df.groupby(['region']).sum().reset_index()
+    sums = cube.groupby(['region'], observed=True)[['count', 'p13a', 'p13b', 'p13c']].sum().reset_index()
+    order = sums.sort_values('count', ascending=False)['region']
 
     sns.set_palette("colorblind")
 
-    sns.barplot(data=sums, x="region", y="p13a", order=df['region'].value_counts().index, ax=ax[0])
+    sns.barplot(data=sums, x="region", y="p13a", order=order, ax=ax[0])
     ax[0].set(ylabel="počet mrtvých", xlabel=None)
 
-    sns.barplot(data=sums, x="region", y="p13b", order=df['region'].value_counts().index, ax=ax[1])
+    sns.barplot(data=sums, x="region", y="p13b", order=order, ax=ax[1])
     ax[1].set(ylabel="počet těžce zraněných", xlabel=None)
 
-    sns.barplot(data=sums, x="region", y="p13c", order=df['region'].value_counts().index, ax=ax[2])
+    sns.barplot(data=sums, x="region", y="p13c", order=order, ax=ax[2])
     ax[2].set(ylabel="počet lehce zraněných", xlabel=None)
 
-    sns.countplot(data=df, x="region", order=df['region'].value_counts().index, ax=ax[3])
+    sns.barplot(data=sums, x="region", y="count", order=order, ax=ax[3])
     ax[3].set(ylabel="počet nehod")
 
     # set background and grids
@@ -111,13 +370,16 @@ def plot_conseq(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     _save_and_show(fig_location, show_figure)
 
 
+@timed("analysis.plot_damage")
 def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
     """
     Renders graph of accident count by damage caused and accident cause
-    :param df: data source
+    :param df: data source, raw data or cube made by make_cube
     :param fig_location: file to save to
     :param show_figure: show figure on screen
     """
+    cube = _as_cube(df)
+
     fig, ax = plt.subplots(2, 2)
     fig.set_size_inches((10, 10))
     fig.suptitle("Počty nehod podle kraje, příčiny nehody a velikosti škody")
@@ -126,22 +388,12 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     sns.set_palette("colorblind")
 
     for index, region in enumerate(regions):
-        data = pd.DataFrame(df[(df.region == region)])
-
-        cost_labels = ('< 50', '50 - 200', '200 - 500', '500 - 1000', '> 1000')
-        data['p53'] = pd.cut(data['p53'], bins=[0, 500, 2000, 5000, 10000, 1000000], include_lowest=True,
-                             labels=cost_labels)
-
-        labels = ('nezaviněná řidičem', 'nepřiměřená rychlost jízdy', 'nesprávné předjíždění', 'nedání přednosti v jízdě',
-                  'nesprávný způsob jízdy', 'technická závada vozidla')
-        data['p12'] = pd.cut(data['p12'], bins=[0, 200, 300, 400, 500, 600, 700], include_lowest=True,
-                             labels=labels)
-
-        data = data.groupby(['p12', 'p53']).size().reset_index()
+        data = cube[cube.region == region]
+        data = data.groupby(['p12', 'p53'], observed=False)['count'].sum().reset_index()
         print(data)
 
         ax[(index // 2, index % 2)].set(yscale="log", title=region)
-        sns.barplot(data=data, y=0, x='p53', hue='p12', ci=None, ax=ax[(index // 2, index % 2)], bottom=0.1)
+        sns.barplot(data=data, y='count', x='p53', hue='p12', ci=None, ax=ax[(index // 2, index % 2)], bottom=0.1)
 
         # set background and grids
         ax[(index // 2, index % 2)].set(facecolor=(0.9, 0.9, 0.9), ylabel=None, xlabel=None)
@@ -155,13 +407,16 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     _save_and_show(fig_location, show_figure)
 
 
+@timed("analysis.plot_surface")
 def plot_surface(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
     """
     Renders graph of accidents on surfaces in time
-    :param df: data source
+    :param df: data source, raw data or cube made by make_cube
     :param fig_location: file to save to
     :param show_figure: show figure on screen
     """
+    cube = _as_cube(df)
+
     fig, ax = plt.subplots(2, 2)
     fig.set_size_inches((12, 8))
     fig.suptitle("Počty nehod podle kraje a povrchu")
@@ -169,26 +424,14 @@ def plot_surface(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     regions = ['MSK', 'JHM', 'OLK', 'PHA']
     sns.set_palette("colorblind")
 
-    rename = {
-        0: 'jiný',
-        1: 'suchý neznečištěný',
-        2: 'suchý znečištěný',
-        3: 'mokrý',
-        4: 'bláto',
-        5: 'náledí, ujetý sníh - posypané',
-        6: 'náledí, ujetý sníh - neposypané',
-        7: 'rozlitý olej, nafta apod.',
-        8: 'souvislý sníh',
-        9: 'náhlá změna stavu',
-    }
-
     for index, region in enumerate(regions):
-        data = pd.DataFrame(df[(df.region == region)])
+        data = cube[cube.region == region]
         i = (index // 2, index % 2)
 
-        counts = pd.crosstab(data.p2a, data.p16)
-        counts.rename(columns=rename, inplace=True)
-        counts = counts.groupby(pd.Grouper(freq='M')).sum()
+        counts = data.pivot_table(index='month', columns='p16', values='count', aggfunc='sum', fill_value=0)
+        # months without accidents are plotted as zero
+        counts = counts.reindex(pd.date_range(counts.index.min(), counts.index.max(), freq='MS'), fill_value=0)
+        counts.rename(columns=_surface_names, inplace=True)
 
         sns.lineplot(data=counts, ax=ax[i], dashes=False)
 
@@ -209,6 +452,7 @@ def plot_surface(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
 
 if __name__ == "__main__":
     df = get_dataframe("data/accidents.pkl.gz", True)
-    # plot_conseq(df, show_figure=True)
-    # plot_damage(df, show_figure=True)
-    plot_surface(df, show_figure=True)
+    cube = make_cube(df)
+    # plot_conseq(cube, show_figure=True)
+    # plot_damage(cube, show_figure=True)
+    plot_surface(cube, show_figure=True)
@@ -0,0 +1,407 @@
+import argparse
+import contextlib
+import filecmp
+import functools
+import http.server
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+
+from download import DataDownloader, _region_to_file
+
+# accidents in one region per month in real data, this is scale 1
+_rows_per_region_month = 600
+
+# columns of frame read by analysis.get_dataframe
+_frame_columns = ['p1', 'p36', 'p37', 'p2a', 'weekday(p2a)', 'p2b', 'p6', 'p7', 'p8', 'p9', 'p10', 'p11', 'p12', 'p13a',
+                  'p13b', 'p13c', 'p14', 'p15', 'p16', 'p17', 'p18', 'p19', 'p20', 'p21', 'p22', 'p23', 'p24', 'p27',
+                  'p28', 'p34', 'p35', 'p39', 'p44', 'p45a', 'p47', 'p48a', 'p49', 'p50a', 'p50b', 'p51', 'p52', 'p53',
+                  'p55a', 'p57', 'p58', 'a', 'b', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'n', 'o', 'p', 'q', 'r',
+                  's', 't', 'p5a', 'region']
+
+# values of free text columns
+_words = np.array(['Ostrava', 'Brno', 'Praha', 'Olomouc', 'Frýdek-Místek', 'Žďár nad Sázavou', 'místní komunikace',
+                   'silnice I. třídy', 'silnice II. třídy', 'dálnice', ''])
+
+
+class _OfflineDownloader(DataDownloader):
+    """DataDownloader which uses only already present zips"""
+    def download_data(self):
+        pass
+
+
+class _ZipHandler(http.server.SimpleHTTPRequestHandler):
+    """Local stand-in of the police server, serves zips of its directory and index page with links to them"""
+    def do_GET(self):
+        if self.path != '/':
+            # files are served with Last-Modified, so conditional requests get 304
+            return super().do_GET()
+        zips = sorted(name for name in os.listdir(self.directory) if name.endswith('.zip'))
+        body = "".join(f'<a href="{name}">ZIP</a>\n' for name in zips).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def _serve_zips(folder: str):
+    """Serves zips of folder over local http while in context
+
+    :param folder: folder with zips
+    :return: url of index page
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_ZipHandler, directory=folder))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _download(url: str, folder: str) -> int:
+    """Downloads all zips from url with new DataDownloader
+
+    :param url: url of index page
+    :param folder: folder to download to
+    :return: number of downloaded zips
+    """
+    downloader = DataDownloader(url=url, folder=folder)
+    downloader.download_data()
+    return len(downloader._sorted_zips())
+
+
+def _check_download(source: str, folder: str):
+    """Raises ValueError if downloaded zips differ from served ones or ignore umask
+
+    :param source: folder with served zips
+    :param folder: folder with downloaded zips
+    """
+    served = sorted(name for name in os.listdir(source) if name.endswith('.zip'))
+    downloaded = sorted(name for name in os.listdir(folder) if name.endswith('.zip'))
+    if served != downloaded:
+        raise ValueError(f"downloaded {downloaded}, expected {served}")
+    _, mismatch, errors = filecmp.cmpfiles(source, folder, served, shallow=False)
+    if mismatch or errors:
+        raise ValueError(f"downloaded zips differ: {mismatch + errors}")
+
+    umask = os.umask(0)
+    os.umask(umask)
+    for name in downloaded:
+        mode = stat.S_IMODE(os.stat(os.path.join(folder, name)).st_mode)
+        if mode != 0o666 & ~umask:
+            raise ValueError(f"{name} has mode {oct(mode)}, expected {oct(0o666 & ~umask)}")
+    if any(name.endswith('.part') for name in os.listdir(folder)):
+        raise ValueError("unfinished downloads were left behind")
+
+
+def _codes(rng: np.random.Generator, low: int, high: int, n: int, empty: float = 0.0) -> np.ndarray:
+    """Returns random integer codes as strings, some of them empty
+
+    :param rng: random generator
+    :param low: lowest value
+    :param high: highest value
+    :param n: number of values
+    :param empty: ratio of empty values
+    """
+    values = rng.integers(low, high + 1, n).astype(str)
+    if empty > 0:
+        values = np.where(rng.random(n) < empty, '', values)
+    return values
+
+
+def _quote(values: np.ndarray) -> np.ndarray:
+    """Returns values wrapped in quotes
+
+    :param values: string values
+    """
+    return np.char.add(np.char.add('"', values), '"')
+
+
+def _region_csv(rng: np.random.Generator, region_code: int, year: int, month: int, first_id: int, n: int) -> bytes:
+    """Returns csv with accidents of one region and month, in layout of police data
+
+    :param rng: random generator
+    :param region_code: number of region from its csv name
+    :param year: year of accidents
+    :param month: month of accidents
+    :param first_id: sequence number of first accident
+    :param n: number of accidents
+    """
+    ids = np.char.add(f"{region_code:02}{year:04}", np.char.zfill((first_id + np.arange(n)).astype(str), 6))
+    days = np.char.zfill(rng.integers(1, 29, n).astype(str), 2)
+    hours = rng.integers(0, 24, n) * 100 + rng.integers(0, 60, n)
+    # invalid times are part of real data too
+    hours = np.where(rng.random(n) < 0.01, 2560, hours)
+
+    columns = [ids, _codes(rng, 0, 8, n), _codes(rng, 1, 60000, n, 0.3), _quote(np.char.add(f"{year:04}-{month:02}-", days)),
+               _codes(rng, 0, 6, n), _quote(np.char.zfill(hours.astype(str), 4))]
+    for x in range(7, 35):
+        if x == 13:
+            columns.append(_codes(rng, 100, 615, n))
+        elif x == 17:
+            columns.append(_codes(rng, 0, 50000, n))
+        else:
+            columns.append(_codes(rng, 0, 9, n, 0.05))
+    columns.append(_quote(np.char.zfill(_codes(rng, 0, 99, n), 2)))
+    for x in range(36, 46):
+        columns.append(_codes(rng, 0, 5000, n) if x == 42 else _codes(rng, 0, 9, n, 0.05))
+    for x in range(46, 52):
+        coords = np.char.add(np.char.add(rng.integers(-1200000, -400000, n).astype(str), ','),
+                             np.char.zfill(rng.integers(0, 100, n).astype(str), 2))
+        columns.append(_quote(np.where(rng.random(n) < 0.05, '', coords)))
+    for x in range(52, 65):
+        columns.append(_quote(rng.choice(_words, n)))
+
+    # some files have one more column
+    if rng.random() < 0.5:
+        columns.append(np.full([n], '', dtype='U1'))
+
+    lines = functools.reduce(lambda a, b: np.char.add(np.char.add(a, ';'), b), columns)
+    return '\r\n'.join(lines.tolist()).encode('1250')
+
+
+def generate_zips(folder: str, scale: float = 1, years: List[int] = None, seed: int = 0) -> int:
+    """Writes monthly zips with synthetic accidents of all regions, in layout expected by DataDownloader
+
+    Like police data, zips are cumulative, zip of month m holds accidents of months 1 to m of its year.
+
+    :param folder: folder to write zips to
+    :param scale: multiple of real accident count
+    :param years: years of data. If its None, uses 2016 to 2020
+    :param seed: seed of random generator
+    :return: number of generated accidents
+    """
+    years = years if years is not None else list(range(2016, 2021))
+    rng = np.random.default_rng(seed)
+    n = max(int(_rows_per_region_month * scale), 1)
+    os.makedirs(folder, exist_ok=True)
+
+    for year in years:
+        # accidents of year so far are kept on disk, every month is generated only once
+        with tempfile.TemporaryDirectory(dir=folder) as parts:
+            for month in range(1, 13):
+                filename = os.path.join(folder, f"datagis-{month:02}-{year}.zip")
+                with ZipFile(filename, 'w', ZIP_DEFLATED, compresslevel=1) as archive:
+                    for member in _region_to_file.values():
+                        part = os.path.join(parts, member)
+                        with open(part, 'ab') as f:
+                            if month > 1:
+                                f.write(b'\r\n')
+                            f.write(_region_csv(rng, int(member[:2]), year, month, (month - 1) * n, n))
+                        with open(part, 'rb') as src, archive.open(member, 'w') as dst:
+                            shutil.copyfileobj(src, dst)
+
+    return n * 12 * len(years) * len(_region_to_file)
+
+
+def generate_frame(filename: str, rows: int, seed: int = 0):
+    """Writes gzipped pickle with synthetic accidents, in layout expected by analysis.get_dataframe
+
+    :param filename: file to write to
+    :param rows: number of accidents
+    :param seed: seed of random generator
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    data = {col: rng.integers(0, 10, rows) for col in _frame_columns}
+    data['p1'] = rng.integers(10 ** 11, 10 ** 12, rows)
+    data['p2a'] = (np.datetime64('2016-01-01') + rng.integers(0, 365 * 5, rows)).astype(str).astype(object)
+    data['p2b'] = np.where(rng.random(rows) < 0.01, 2560, rng.integers(0, 24, rows) * 100 + rng.integers(0, 60, rows))
+    data['p12'] = rng.integers(100, 616, rows)
+    data['p13a'] = rng.integers(0, 2, rows)
+    data['p13b'] = rng.integers(0, 3, rows)
+    data['p13c'] = rng.integers(0, 4, rows)
+    data['p14'] = rng.integers(0, 5000, rows)
+    data['p19'] = rng.integers(1, 8, rows)
+    data['p37'] = rng.integers(0, 60000, rows)
+    data['p53'] = rng.integers(0, 20000, rows)
+    data['p5a'] = rng.integers(1, 3, rows)
+    for col in ('a', 'b', 'f', 'g'):
+        data[col] = rng.normal(0, 1e5, rows)
+    # coordinates in S-JTSK, some accidents have none
+    missing = rng.random(rows) < 0.05
+    data['d'] = np.where(missing, np.nan, rng.uniform(-900000, -450000, rows))
+    data['e'] = np.where(missing, np.nan, rng.uniform(-1230000, -935000, rows))
+    for col in ('h', 'i', 'j', 'k', 'l', 'n', 'o', 'p', 'q', 'r', 's', 't'):
+        data[col] = rng.choice(_words, rows).astype(object)
+    data['region'] = rng.choice(list(_region_to_file.keys()), rows).astype(object)
+
+    # random data doesn't compress well, so fastest level is used
+    pd.DataFrame(data).to_pickle(filename, compression={'method': 'gzip', 'compresslevel': 1})
+
+
+def _measure(results: Dict, name: str, fn: Callable, *args, **kwargs):
+    """Runs stage and stores its wall time, failure of stage is stored instead of time
+
+    :param results: stage results of scale
+    :param name: name of stage
+    :param fn: stage to run
+    :return: result of stage, or None if it failed
+    """
+    start = time.perf_counter()
+    try:
+        # output of stages would mix with json report
+        with contextlib.redirect_stdout(sys.stderr):
+            value = fn(*args, **kwargs)
+    except Exception as e:
+        results[name] = {"error": f"{type(e).__name__}: {e}"}
+        return None
+    results[name] = {"seconds": time.perf_counter() - start}
+    return value
+
+
+def run_scale(folder: str, scale: float, years: List[int] = None) -> Dict:
+    """Generates data of one scale and measures all stages of the pipeline on it
+
+    :param folder: empty folder for generated data
+    :param scale: multiple of real accident count
+    :param years: years of data. If its None, uses 2016 to 2020
+    :return: row count and time of every stage
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import analysis
+    import doc
+    import get_stat
+
+    stages = {}
+    result = {"scale": scale, "stages": stages}
+    regions = list(_region_to_file.keys())
+
+    rows = _measure(stages, "generate_zips", generate_zips, folder, scale, years)
+    result["rows"] = rows
+
+    # zips are downloaded from local stand-in of the police server, second run only revalidates them
+    download_folder = os.path.join(folder, "download")
+    with _serve_zips(folder) as url:
+        _measure(stages, "download", _download, url, download_folder)
+        _measure(stages, "download_revalidate", _download, url, download_folder)
+    _measure(stages, "download_check", _check_download, folder, download_folder)
+
+    downloader = _OfflineDownloader(folder=folder)
+    parsed = _measure(stages, "parse", downloader.parse_regions_data, regions)
+
+    for cache_format in ("pickle", "mmap"):
+        writer = _OfflineDownloader(folder=folder, cache_format=cache_format)
+        if parsed is not None:
+            _measure(stages, f"cache_write_{cache_format}",
+                     lambda: [writer._write_cache(region, parsed[region]) for region in regions])
+        _measure(stages, f"get_list_{cache_format}", _OfflineDownloader(folder=folder, cache_format=cache_format).get_list)
+    data_source = _OfflineDownloader(folder=folder).get_list()
+
+    frame_file = os.path.join(folder, "accidents.pkl.gz")
+    _measure(stages, "generate_frame", generate_frame, frame_file, rows)
+    _measure(stages, "get_dataframe_cold", analysis.get_dataframe, frame_file, cache=True)
+    df = _measure(stages, "get_dataframe_warm", analysis.get_dataframe, frame_file)
+
+    figures = os.path.join(folder, "figures")
+    plots = []
+    if df is not None:
+        cube = _measure(stages, "make_cube", analysis.make_cube, df)
+        if cube is not None:
+            plots += [("plot_conseq", analysis.plot_conseq, cube), ("plot_damage", analysis.plot_damage, cube),
+                      ("plot_surface", analysis.plot_surface, cube)]
+        plots.append(("plot_visibility", doc.plot_visibility, df))
+    plots.append(("plot_stat", get_stat.plot_stat, data_source))
+
+    if df is not None:
+        try:
+            import geo
+        except Exception as e:
+            stages["make_geo"] = {"error": f"{type(e).__name__}: {e}"}
+        else:
+            gdf = _measure(stages, "make_geo", geo.make_geo, df)
+            if gdf is not None:
+                plots += [("plot_geo", geo.plot_geo, gdf), ("plot_cluster", geo.plot_cluster, gdf)]
+
+    for name, plot, data in plots:
+        _measure(stages, name, _plot_offline, plot, data, os.path.join(figures, f"{name}.png"))
+        plt.close('all')
+
+    return result
+
+
+def _plot_offline(plot: Callable, data, fig_location: str):
+    """Renders figure without basemap tiles, which would need network
+
+    :param plot: plot function
+    :param data: data source of plot
+    :param fig_location: file to save figure to
+    """
+    import contextily
+    add_basemap = contextily.add_basemap
+    contextily.add_basemap = lambda *args, **kwargs: None
+    try:
+        plot(data, fig_location=fig_location, show_figure=False)
+    finally:
+        contextily.add_basemap = add_basemap
+
+
+def _write_report(report: Dict, output: str):
+    """Writes report to file, file is replaced at once so it always holds a complete report
+
+    :param report: report to write
+    :param output: file to write to
+    """
+    with open(output + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(output + ".tmp", output)
+
+
+def run(scales: List[float], years: List[int] = None, folder: str = None, output: str = None) -> Dict:
+    """Measures all stages of the pipeline for every scale
+
+    Result of every scale is written as soon as it completes, so finished scales are kept even if a later one fails.
+
+    :param scales: multiples of real accident count
+    :param years: years of data. If its None, uses 2016 to 2020
+    :param folder: folder for generated data. If its None, temporary folder is used and removed afterwards
+    :param output: file for report, rewritten after every scale. If its None, result of every scale is printed
+     as one json line
+    :return: results of all scales
+    """
+    report = {"rows_per_region_month": _rows_per_region_month, "results": []}
+    for scale in scales:
+        scale_folder = tempfile.mkdtemp(prefix="izv-bench-") if folder is None else os.path.join(folder, f"scale_{scale}")
+        try:
+            result = run_scale(scale_folder, scale, years)
+        finally:
+            if folder is None:
+                shutil.rmtree(scale_folder, ignore_errors=True)
+        report["results"].append(result)
+
+        if output is not None:
+            _write_report(report, output)
+        else:
+            print(json.dumps(result), flush=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # zips are cumulative, so scale 1 already parses several times the real accident count
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.1, 0.5, 1])
+    parser.add_argument('--years', type=int, nargs='+')
+    parser.add_argument('--folder')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    run(args.scales, args.years, args.folder, args.output)
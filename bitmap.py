@@ -0,0 +1,160 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from instrument import timed
+
+# columns with more distinct values are not indexed by default
+_max_values = 256
+
+# number of set bits of every byte value
+_popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int64)
+
+
+def _packed_size(n_rows: int) -> int:
+    """Returns number of bytes of bitmap with given number of rows"""
+    return (n_rows + 7) // 8
+
+
+def _append_bits(packed: np.ndarray, n_rows: int, bits: np.ndarray) -> np.ndarray:
+    """Returns bitmap extended by new rows
+
+    :param packed: bitmap of existing rows
+    :param n_rows: number of existing rows
+    :param bits: boolean values of new rows
+    """
+    offset = n_rows % 8
+    if offset == 0:
+        return np.concatenate([packed, np.packbits(bits)])
+    # last byte is only partly used, so it is repacked together with new rows
+    head = np.unpackbits(packed[-1:])[:offset].astype(bool)
+    return np.concatenate([packed[:-1], np.packbits(np.concatenate([head, bits]))])
+
+
+def _column_values(column: pd.Series) -> Tuple[List, np.ndarray]:
+    """Returns distinct values of column and position of value of every row among them, missing values get -1
+
+    :param column: column to index, categories are indexed through their codes
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # missing values have code -1, so they are first of unique codes
+        unique, inverse = np.unique(column.cat.codes.to_numpy(), return_inverse=True)
+        if len(unique) > 0 and unique[0] == -1:
+            unique, inverse = unique[1:], inverse - 1
+        return column.cat.categories[unique].tolist(), inverse
+    unique, inverse = np.unique(column.to_numpy(), return_inverse=True)
+    return unique.tolist(), inverse
+
+
+def _indexable(column: pd.Series) -> bool:
+    """Returns true for small integer and category columns, which are indexed by default"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return True
+    return pd.api.types.is_integer_dtype(column.dtype) and column.dtype.itemsize == 1
+
+
+class BitmapIndex:
+    """Packed bitmap of rows for every value of low cardinality columns
+
+    Queries are conjunctions of columns, every column matches any of given values.
+    Missing values are not indexed, so their rows match no value.
+    Counts and selections combine bitmaps, frame itself is not scanned.
+    """
+    def __init__(self, n_rows: int = 0, bitmaps: Dict[str, Dict] = None):
+        """
+        :param n_rows: number of indexed rows
+        :param bitmaps: mapping of column names to mappings of values to bitmaps made by np.packbits
+        """
+        self.n_rows = n_rows
+        self.bitmaps = bitmaps if bitmaps is not None else {}
+
+    @classmethod
+    @timed("bitmap.build")
+    def build(cls, df: pd.DataFrame, columns: Iterable[str] = None, max_values: int = _max_values) -> 'BitmapIndex':
+        """Creates index of frame
+
+        :param df: indexed data
+        :param columns: columns to index. If its None, int8 and category columns with at most max_values
+         distinct values are used
+        :param max_values: limit of distinct values of automatically chosen columns
+        """
+        if columns is None:
+            columns = [name for name in df.columns if _indexable(df[name]) and df[name].nunique() <= max_values]
+        index = cls(0, {name: {} for name in columns})
+        index.append(df)
+        return index
+
+    def append(self, df: pd.DataFrame):
+        """Adds rows to the end of index, existing bitmaps are only extended
+
+        :param df: new rows, with all indexed columns
+        """
+        for name, bitmaps in self.bitmaps.items():
+            unique, codes = _column_values(df[name])
+            for code, value in enumerate(unique):
+                if value not in bitmaps:
+                    bitmaps[value] = np.zeros([_packed_size(self.n_rows)], dtype=np.uint8)
+                bitmaps[value] = _append_bits(bitmaps[value], self.n_rows, codes == code)
+            # values missing in new rows get zeros
+            for value in set(bitmaps) - set(unique):
+                bitmaps[value] = _append_bits(bitmaps[value], self.n_rows, np.zeros([len(df)], dtype=bool))
+        self.n_rows += len(df)
+
+    @property
+    def columns(self) -> List[str]:
+        """Indexed columns"""
+        return list(self.bitmaps)
+
+    def values(self, column: str) -> List:
+        """Returns all indexed values of column
+
+        :param column: indexed column
+        """
+        return sorted(self.bitmaps[column], key=str)
+
+    def mask(self, **conditions) -> np.ndarray:
+        """Returns packed bitmap of rows matching all conditions
+
+        :param conditions: column names with value or list of values, row matches if it has any of them
+        """
+        result = None
+        for name, values in conditions.items():
+            if name not in self.bitmaps:
+                raise KeyError(f"column {name} is not indexed")
+            if isinstance(values, (list, tuple, set, np.ndarray)):
+                values = list(values)
+            else:
+                values = [values]
+
+            matched = np.zeros([_packed_size(self.n_rows)], dtype=np.uint8)
+            for value in values:
+                if value in self.bitmaps[name]:
+                    matched |= self.bitmaps[name][value]
+            result = matched if result is None else result & matched
+
+        if result is None:
+            # no condition matches every row
+            result = np.packbits(np.ones([self.n_rows], dtype=bool))
+        return result
+
+    def count(self, **conditions) -> int:
+        """Returns number of rows matching all conditions
+
+        :param conditions: see mask
+        """
+        return int(_popcount[self.mask(**conditions)].sum())
+
+    def select(self, **conditions) -> np.ndarray:
+        """Returns boolean mask of rows matching all conditions, usable for filtering of indexed frame
+
+        :param conditions: see mask
+        """
+        return np.unpackbits(self.mask(**conditions), count=self.n_rows).astype(bool)
+
+    def rows(self, **conditions) -> np.ndarray:
+        """Returns positions of rows matching all conditions, usable with iloc
+
+        :param conditions: see mask
+        """
+        return np.flatnonzero(self.select(**conditions))
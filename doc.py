@@ -2,83 +2,142 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
-from typing import Tuple, List
+from typing import Callable, Dict, Iterable, List, Tuple
 
+from download import Batch
+from instrument import span, timed
 
-def time_map(val):
+
+# minutes of time are in last two digits of p2b, hours 25 mean unknown time
+_hours_in_day = 24
+_bucket_hours = 6
+# names of time and visibility (p19) columns in batches of DataDownloader.iter_batches
+_time_column = "Čas nehody"
+_visibility_column = "Viditelnost"
+
+
+def hour_codes(p2b) -> np.ndarray:
     """
-    Maps input time string to hour integer if valid
-    :param val: time string
-    :return: time integer
+    Converts raw p2b time codes into hours
+    :param p2b: time codes, e.g. 1738
+    :return: hour of every code, -1 for invalid times
     """
-    normalized = int(val) // 100
-    if normalized == 25:
-        return None
-    return normalized
+    hours = np.asarray(p2b, dtype=np.int64) // 100
+    return np.where((hours >= 0) & (hours < _hours_in_day), hours, -1)
 
 
-def grab_stat(df: pd.DataFrame, stat: str):
+def _hourly_counts(p2b, masks: List[np.ndarray]) -> np.ndarray:
     """
-    Creates dictionary with hour keys and assoc. values
-    :param df: source dataframe
-    :param stat: dataframe series to use
-    :return: dictionary with hour keys and assoc. values
+    Counts rows per hour and combination of filters in one bincount, rows with invalid time are skipped
+    :param p2b: raw time codes
+    :param masks: boolean filters with one value for every time code
+    :return: counts with shape (2 ** len(masks), 24), row is bit set of filters rows passed
     """
-    times = {}
+    hours = hour_codes(p2b)
+    valid = hours >= 0
 
-    for hour, row in df.iterrows():
-        hour = int(hour)
-        times[hour] = row[stat]
-    return times
+    # every row gets key of its hour and bit set of filters it passes
+    combination = np.zeros([len(hours)], dtype=np.int64)
+    for bit, mask in enumerate(masks):
+        combination |= np.asarray(mask, dtype=bool).astype(np.int64) << bit
+    keys = combination[valid] * _hours_in_day + hours[valid]
+    return np.bincount(keys, minlength=(1 << len(masks)) * _hours_in_day).reshape(-1, _hours_in_day)
 
 
-def list_from_dict(d) -> Tuple[List, List]:
+def _profile_tables(counts: np.ndarray, names: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Returns two tuples with x and y values to plot
-    :param d: dictionary to use
-    :return: tuples with x and y values to plot
+    Creates hour and bucket tables from counts made by _hourly_counts
+    :param counts: counts per combination of filters and hour
+    :param names: names of filters
+    :return: tables returned by hourly_profile
     """
-    x = []
-    y = []
-    for key in sorted(d):
-        x.append(key)
-        y.append(d[key])
-    # loop
-    x.append(24)
-    y.append(y[0])
-    return x, y
+    combinations = np.arange(len(counts))
+    profile = pd.DataFrame({'total': counts.sum(axis=0)}, index=pd.RangeIndex(_hours_in_day, name='hour'))
+    for bit, name in enumerate(names):
+        profile[name] = counts[(combinations >> bit) & 1 == 1].sum(axis=0)
+    for name in names:
+        profile[f'{name}_ratio'] = profile[name] / profile['total'].replace(0, np.nan)
 
+    sums = profile[['total'] + list(names)]
+    buckets = sums.groupby(sums.index // _bucket_hours).sum()
+    buckets.index = [f'{i * _bucket_hours} - {(i + 1) * _bucket_hours}' for i in buckets.index]
+    return profile, buckets
+
+
+@timed("doc.hourly_profile")
+def hourly_profile(df: pd.DataFrame, masks: Dict[str, np.ndarray] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Counts accidents per hour of day, in all and in every filter, rows with invalid time are skipped
+    All counts come from one bincount over hour and combination of filters
+    :param df: data source, needs p2b column
+    :param masks: named boolean filters with one value for every row of df
+    :return: table indexed by hour with columns total, every filter name and its ratio to total (name_ratio),
+     and table of the same counts summed into 6 hour buckets
+    """
+    masks = masks or {}
+    return _profile_tables(_hourly_counts(df['p2b'], list(masks.values())), list(masks))
 
-if __name__ == "__main__":
-    # load data
-    df = pd.read_pickle("accidents.pkl.gz")
 
-    # create new series in dataframe
-    df['hour'] = df['p2b'].map(time_map)
+@timed("doc.hourly_profile_batches")
+def hourly_profile_batches(batches: Iterable[Batch], masks: Dict[str, Callable] = None) \
+        -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Same as hourly_profile, but counts batches yielded by DataDownloader.iter_batches one by one
+    :param batches: batches with time column
+    :param masks: named functions, which get header and columns of batch and return its boolean filter
+    :return: tables returned by hourly_profile
+    """
+    masks = masks or {}
+    counts = np.zeros([1 << len(masks), _hours_in_day], dtype=np.int64)
+    for _region, _month, header, columns in batches:
+        batch_masks = [mask(header, columns) for mask in masks.values()]
+        counts += _hourly_counts(columns[header.index(_time_column)], batch_masks)
+    return _profile_tables(counts, list(masks))
 
-    # drop all invalid times
-    df = df.dropna(subset=['hour'])
 
-    # create grouped views for later use
+def _bad_visibility(df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns mask of accidents in bad visibility
+    :param df: data source
+    :return: boolean mask
+    """
     # p19 is visibility stat
     # 1 and 4 are good visibility in day and night
-    grouped_bad_vis = df[(df.p19 != 1) & (df.p19 != 4)].groupby(['hour'])
-    grouped = df.groupby(['hour'])
+    p19 = df['p19'].to_numpy()
+    return (p19 != 1) & (p19 != 4)
 
-    # print
-    print(f'total accidents = {df.shape[0]}')
-    print(f'accidents at night = {df[((df.hour > 20) | (df.hour < 6))].shape[0]}')
-    print(f'accidents in bad visibility = {df[(df.p19 != 1) & (df.p19 != 4)].shape[0]}')
-    print(f'accidents in bad visibility at night = {df[(df.p19 != 1) & (df.p19 != 4) & ((df.hour > 20) | (df.hour < 6))].shape[0]}')
 
-    x, y = list_from_dict(grab_stat(grouped.count(), 'region'))
-    x_1, y_1 = list_from_dict(grab_stat(grouped_bad_vis.count(), 'region'))
+def _bad_visibility_batch(header: List[str], columns: List[np.ndarray]) -> np.ndarray:
+    """
+    Returns mask of accidents in bad visibility in batch of DataDownloader.iter_batches
+    :param header: names of columns
+    :param columns: columns of batch
+    :return: boolean mask
+    """
+    p19 = np.asarray(columns[header.index(_visibility_column)])
+    return (p19 != 1) & (p19 != 4)
+
+
+@timed("doc.plot_visibility")
+def plot_visibility(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
+    """
+    Renders graph of accident counts per hour, in all and in bad visibility
+    :param df: data source
+    :param fig_location: file to save to
+    :param show_figure: show figure on screen
+    """
+    profile, _ = hourly_profile(df, {'bad_visibility': _bad_visibility(df)})
+
+    # first hour is repeated at the end, so the line loops over midnight
+    x = np.arange(_hours_in_day + 1)
+    y = np.append(profile['total'].to_numpy(), profile['total'].iat[0])
+    y_1 = np.append(profile['bad_visibility'].to_numpy(), profile['bad_visibility'].iat[0])
 
     fig, ax = plt.subplots(1, 1, figsize=(10, 5))
 
     # plot per hour counts
     ax.plot(x, y, label="Počet nehod v danou hodinu")
-    ax.plot(x_1, y_1, label="Počet nehod v danou hodinu se špatnou viditelností", color='gold')
+    ax.plot(x, y_1, label="Počet nehod v danou hodinu se špatnou viditelností", color='gold')
 
     # figure options
     ax.set_xlim(0, 24)
@@ -90,7 +149,7 @@ if __name__ == "__main__":
 
     # plot ratio
     ax_2 = ax.twinx()
-    ax_2.plot(x, [y_1[i] / y[i] for i in range(len(x))], color='black', linestyle='dashed', alpha=0.2)
+    ax_2.plot(x, y_1 / y, color='black', linestyle='dashed', alpha=0.2)
 
     # second axis options
     ax_2.set_ylim(0, 1)
@@ -101,9 +160,31 @@ if __name__ == "__main__":
     ax.legend(loc='upper left')
     fig.tight_layout()
 
-    plt.savefig('fig.png', dpi=200)
+    if fig_location is not None:
+        with span("savefig"):
+            plt.savefig(fig_location, dpi=200)
+
+    if show_figure:
+        plt.show()
+
+
+if __name__ == "__main__":
+    # load data
+    df = pd.read_pickle("accidents.pkl.gz")
+
+    # one pass gives all counts, night is from 21 to 6
+    profile, buckets = hourly_profile(df, {'bad_visibility': _bad_visibility(df)})
+    night = profile[(profile.index > 20) | (profile.index < 6)]
+
+    # print
+    print(f'total accidents = {profile.total.sum()}')
+    print(f'accidents at night = {night.total.sum()}')
+    print(f'accidents in bad visibility = {profile.bad_visibility.sum()}')
+    print(f'accidents in bad visibility at night = {night.bad_visibility.sum()}')
+
+    plot_visibility(df, 'fig.png')
 
     # now print table
     print("hodina,celkem,špatná viditelnost")
-    for i in range(4):
-        print(f'{i * 6} - {(i + 1) * 6},{sum(y[i * 6:i * 6 + 6])},{sum(y_1[i * 6:i * 6 + 6])}')
+    for bucket, row in buckets.iterrows():
+        print(f'{bucket},{row.total},{row.bad_visibility}')
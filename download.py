@@ -1,14 +1,18 @@
 import errno
+import json
 import pickle
-from typing import Tuple, List
+import shutil
+import threading
+from typing import Tuple, List, Dict, Iterator, Optional, Union
 
-import requests
 import os
 import re
 import gzip
 import numpy as np
 from zipfile import ZipFile
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from instrument import span, timed
 
 # map of regions to filename
 _region_to_file = {
@@ -97,144 +101,1080 @@ _data_header_types = [
     ["Lokalita nehody",                           "U30"],
 ]
 
+# columns where empty value means -1
+_cols_with_default = [2, 3, 5] + [x for x in range(7, 35)] + [x for x in range(36, 46)]
+# float columns with decimal comma, empty or invalid value means NaN
+_cols_with_default_float = [46, 47, 48, 49, 50, 51]
+# columns with quoted strings
+_cols_with_strip_str = [4, 6, 35, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 64]
+
+# free text columns, which can be dictionary encoded
+_cols_dictionary = [52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64]
+
+# first and last day, None means unbounded
+DateRange = Optional[Tuple[Union[str, np.datetime64, None], Union[str, np.datetime64, None]]]
+# region, month (None if batches are not split by month), header and columns of batch
+Batch = Tuple[str, Optional[np.datetime64], List[str], List[np.ndarray]]
+
+# month and year in zip filename
+_zip_pattern = re.compile(r"(\d{2})?-?(\d{4})")
+
+# manifest of memory mapped cache
+_manifest_name = "manifest.json"
+# zips the cache of region was built from, every cache format has its own file
+_sources_filename = "sources_{}.{}.json"
+# sorted ids of accidents in cache of region, positions point into cache of one format
+_index_filename = "ids_{}.{}.npy"
+# ETag and Last-Modified headers of downloaded zips
+_validators_filename = "downloads.json"
+# timeout of http requests in seconds
+_timeout = 60
+# size of chunks written while downloading zip
+_chunk_size = 1 << 16
+# default maximum number of rows in one batch of iter_batches
+_batch_rows = 100000
+
+
+def _zip_sort_key(filename: str) -> int:
+    """Returns sort key of zip file, based on month and year in its name
+
+    :param filename: name of zip file
+    """
+    date = _zip_pattern.search(filename)
+    month, year = date.group(1), date.group(2)
+    # this way, if no month is found in filename, file will have priority
+    if month is None:
+        return int(year) * 100 + 13
+    else:
+        return int(year) * 100 + int(month)
+
+
+def _code_dtype(size: int) -> str:
+    """Returns smallest integer type able to hold codes of vocabulary
+
+    :param size: size of vocabulary
+    """
+    if size <= np.iinfo('i1').max:
+        return 'i1'
+    elif size <= np.iinfo('i2').max:
+        return 'i2'
+    return 'i4'
+
+
+class DictionaryColumn:
+    """Dictionary encoded string column, stores integer codes into shared vocabulary of unique values"""
+    def __init__(self, codes: np.ndarray, categories: np.ndarray):
+        """
+        :param codes: index into categories for every row
+        :param categories: sorted unique values
+        """
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def encode(cls, column: np.ndarray) -> 'DictionaryColumn':
+        """Creates encoded column from string array
+
+        :param column: column to encode
+        """
+        categories, codes = np.unique(column, return_inverse=True)
+        return cls(codes.astype(_code_dtype(len(categories))), categories)
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Type of decoded values"""
+        return self.categories.dtype
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.categories[self.codes[key]]
+        # vocabulary is shared with selection
+        return DictionaryColumn(self.codes[key], self.categories)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.decode() if dtype is None else self.decode().astype(dtype)
+
+    def decode(self) -> np.ndarray:
+        """Returns column as plain string array"""
+        return self.categories[self.codes]
+
+    def to_categorical(self):
+        """Returns column as pandas Categorical, without copying the codes"""
+        import pandas as pd
+        return pd.Categorical.from_codes(self.codes, categories=self.categories)
+
+
+def _normalize_date_range(date_range: DateRange) -> Tuple[Optional[np.datetime64], Optional[np.datetime64]]:
+    """Converts both ends of date range into days, missing ends are None
+
+    :param date_range: first and last day, both can be None
+    """
+    if date_range is None:
+        return None, None
+    first, last = date_range
+    first = np.datetime64(first, 'D') if first is not None else None
+    last = np.datetime64(last, 'D') if last is not None else None
+    return first, last
+
+
+def _zip_in_range(filename: str, first: Optional[np.datetime64], last: Optional[np.datetime64]) -> bool:
+    """Returns true if zip can contain accidents from date range, based on month and year in its name
+
+    :param filename: name of zip file
+    :param first: first day of range
+    :param last: last day of range
+    """
+    date = _zip_pattern.search(filename)
+    month, year = date.group(1), date.group(2)
+    # zip contains accidents from start of its year up to its month
+    zip_first = np.datetime64(f"{year}-01-01", 'D')
+    if month is None:
+        zip_last = np.datetime64(f"{year}-12-31", 'D')
+    else:
+        zip_last = (np.datetime64(f"{year}-{month}", 'M') + 1).astype('datetime64[D]') - 1
+
+    if first is not None and zip_last < first:
+        return False
+    if last is not None and zip_first > last:
+        return False
+    return True
+
+
+def _id_column(ids) -> np.ndarray:
+    """Converts accident ids into 64 bit integers
+
+    :param ids: ids as strings or integers
+    """
+    return np.asarray(ids).astype(np.int64)
+
+
+def _sorted_contains(sorted_values: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Returns mask of values, which are present in sorted array
+
+    :param sorted_values: sorted array to search in
+    :param values: values to search for
+    """
+    if len(sorted_values) == 0:
+        return np.zeros([len(values)], dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def _build_index(ids: np.ndarray) -> np.ndarray:
+    """Returns index of id column, first row are sorted ids, second row their positions in column
+
+    :param ids: id column
+    """
+    ids = _id_column(ids)
+    order = np.argsort(ids, kind='stable')
+    return np.stack([ids[order], order.astype(np.int64)])
+
+
+def _parse_float(value: str) -> float:
+    """Parses float with decimal comma, returns NaN for invalid values
+
+    :param value: stripped string value
+    """
+    if len(value) == 0:
+        return float('nan')
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        return float('nan')
+
+
+def _float_column(column: np.ndarray) -> np.ndarray:
+    """Converts column of quoted strings with decimal comma into floats
+
+    :param column: raw string column
+    """
+    if len(column) == 0:
+        return np.empty([0], dtype='f8')
+    column = np.char.replace(np.char.strip(column, '"'), ',', '.')
+    column = np.where(column == '', 'nan', column)
+    try:
+        # convert through double, same as python float
+        return column.astype('f8')
+    except ValueError:
+        # some values are invalid, so convert only unique values one by one
+        unique, inverse = np.unique(column, return_inverse=True)
+        return np.array([_parse_float(x) for x in unique], dtype='f8')[inverse]
+
+
+def _rows_to_columns(region: str, rows: List[List[str]], dictionary_encode: bool = False) -> List[np.ndarray]:
+    """Converts rows of raw csv values into typed columns, whole column at a time
+
+    :param region: region code to fill into first column
+    :param rows: rows with 64 raw string values
+    :param dictionary_encode: return free text columns as DictionaryColumn
+    """
+    types = list(map(lambda x: x[1], _data_header_types))
+    raw_columns = list(zip(*rows)) if len(rows) > 0 else [() for _ in range(64)]
+
+    numpy_arrays = [np.full([len(rows)], region, dtype=types[0])]
+    for x in range(1, 65):
+        column = np.array(raw_columns[x - 1], dtype=str)
+
+        if x in _cols_with_default:
+            column = np.where(column == '', '-1', column)
+        elif x in _cols_with_strip_str:
+            column = np.char.strip(column, '"')
+        elif x in _cols_with_default_float:
+            column = _float_column(column)
+
+        column = column.astype(types[x])
+        if dictionary_encode and x in _cols_dictionary:
+            column = DictionaryColumn.encode(column)
+        numpy_arrays.append(column)
+
+    return numpy_arrays
+
+
+def _encode_columns(columns: List[np.ndarray], dictionary_encode: bool) -> List[np.ndarray]:
+    """Encodes or decodes free text columns, so they match selected representation
+
+    :param columns: parsed columns
+    :param dictionary_encode: return free text columns as DictionaryColumn
+    """
+    columns = list(columns)
+    for x in _cols_dictionary:
+        if dictionary_encode and not isinstance(columns[x], DictionaryColumn):
+            columns[x] = DictionaryColumn.encode(columns[x])
+        elif not dictionary_encode and isinstance(columns[x], DictionaryColumn):
+            columns[x] = columns[x].decode()
+    return columns
+
+
+def _merge_dictionary(parts: List[DictionaryColumn]) -> DictionaryColumn:
+    """Merges encoded columns into one with vocabulary of all parts
+
+    :param parts: columns to merge
+    """
+    categories = np.unique(np.concatenate([part.categories for part in parts]))
+    codes = np.empty([sum(len(part) for part in parts)], dtype=_code_dtype(len(categories)))
+
+    start = 0
+    for part in parts:
+        # remap codes of part into merged vocabulary
+        mapping = np.searchsorted(categories, part.categories).astype(codes.dtype)
+        codes[start:start + len(part)] = mapping[part.codes]
+        start += len(part)
+    return DictionaryColumn(codes, categories)
+
+
+def _merge_columns(parts: List[List[np.ndarray]]) -> List[np.ndarray]:
+    """Merges columns of multiple regions, output is allocated once and every value is copied only once
+
+    :param parts: columns of every region
+    """
+    if len(parts) == 0:
+        return []
+    if len(parts) == 1:
+        return list(parts[0])
+
+    length = sum(len(part[0]) for part in parts)
+    merged = []
+    for x in range(len(parts[0])):
+        if isinstance(parts[0][x], DictionaryColumn):
+            merged.append(_merge_dictionary([part[x] for part in parts]))
+            continue
+        column = np.empty([length], dtype=parts[0][x].dtype)
+        np.concatenate([part[x] for part in parts], out=column)
+        merged.append(column)
+    return merged
+
+
+def _write_array(path: str, filename: str, array: np.ndarray) -> Dict:
+    """Writes array as raw binary file and returns its manifest entry
+
+    :param path: cache directory
+    :param filename: name of file in cache directory
+    :param array: array to write
+    """
+    np.ascontiguousarray(array).tofile(os.path.join(path, filename))
+    return {"dtype": array.dtype.str, "length": len(array), "file": filename}
+
+
+def _map_array(path: str, entry: Dict) -> np.ndarray:
+    """Maps array from raw binary file described by manifest entry
+
+    :param path: cache directory
+    :param entry: manifest entry of array
+    """
+    dtype = np.dtype(entry["dtype"])
+    if entry["length"] == 0:
+        # empty file can't be mapped
+        return np.empty([0], dtype=dtype)
+    return np.memmap(os.path.join(path, entry["file"]), dtype=dtype, mode='r', shape=(entry["length"],))
+
+
+def _write_columns(path: str, region_data: Tuple[List[str], List[np.ndarray]]):
+    """Writes columns as raw binary files with manifest of their names, types and lengths
+
+    :param path: cache directory
+    :param region_data: header and columns to write
+    """
+    header, columns = region_data
+    tmp_path = path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = []
+    for x, (name, column) in enumerate(zip(header, columns)):
+        entry = {"name": name}
+        if isinstance(column, DictionaryColumn):
+            entry["categories"] = _write_array(tmp_path, f"{x:02}.categories.bin", column.categories)
+            column = column.codes
+        entry.update(_write_array(tmp_path, f"{x:02}.bin", column))
+        manifest.append(entry)
+
+    with open(os.path.join(tmp_path, _manifest_name), 'w', encoding='utf-8') as f:
+        json.dump({"columns": manifest}, f, ensure_ascii=False)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def _read_columns(path: str) -> Tuple[List[str], List[np.ndarray]]:
+    """Maps columns written by _write_columns, pages are read only when touched
+
+    :param path: cache directory
+    """
+    with open(os.path.join(path, _manifest_name), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)["columns"]
+
+    header = []
+    columns = []
+    for column in manifest:
+        header.append(column["name"])
+        if "categories" in column:
+            columns.append(DictionaryColumn(_map_array(path, column), _map_array(path, column["categories"])))
+        else:
+            columns.append(_map_array(path, column))
+    return header, columns
+
 
 class DataDownloader:
     """Handles downloading and parsing of police data"""
-    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz"):
+    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz",
+                 cache_format="pickle", cache_dirname="data_{}.cols", download_workers=4, revalidate=True,
+                 dictionary_encode=False):
+        """
+        :param url: url of page with zips
+        :param folder: folder for zips and cache files
+        :param cache_filename: name of gzipped pickle cache file of region
+        :param cache_format: 'pickle' for gzipped pickle cache files, 'mmap' for directories with memory mapped columns
+        :param cache_dirname: name of memory mapped cache directory of region
+        :param download_workers: maximum number of concurrent downloads
+        :param revalidate: check already downloaded zips for changes with conditional requests
+        :param dictionary_encode: return and cache free text columns as DictionaryColumn with shared vocabulary
+        """
+        if cache_format not in ("pickle", "mmap"):
+            raise ValueError(f"unknown cache format '{cache_format}'")
         self.cache_filename = cache_filename
+        self.cache_format = cache_format
+        self.cache_dirname = cache_dirname
         self.folder = folder
         self.url = url
+        self.download_workers = download_workers
+        self.revalidate = revalidate
+        self.dictionary_encode = dictionary_encode
         self.cache = dict()
+        self._indexes = dict()
+        self._session = None
+        self._links = None
+        self._checked = set()
 
-    def download_data(self):
-        """Downloads all zips with data"""
-        res = requests.get(self.url, headers={'User-Agent': 'Mozilla 5.0'})
-        soup = BeautifulSoup(res.text, 'html.parser')
+    def _worker_args(self) -> Dict:
+        """Returns constructor arguments for copies of this downloader in worker processes"""
+        return {"url": self.url, "folder": self.folder, "cache_filename": self.cache_filename,
+                "cache_format": self.cache_format, "cache_dirname": self.cache_dirname,
+                "dictionary_encode": self.dictionary_encode}
+
+    def _get_session(self) -> 'requests.Session':
+        """Returns session with pooled connections, shared by all downloads"""
+        if self._session is None:
+            # networking is imported only when something is downloaded, so cached runs start faster
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._session = requests.Session()
+            self._session.headers.update({'User-Agent': 'Mozilla 5.0'})
+            adapter = HTTPAdapter(pool_maxsize=max(self.download_workers, 1))
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def _zip_links(self) -> List[str]:
+        """Returns links to all zips on the index page, page is fetched only once"""
+        if self._links is None:
+            from bs4 import BeautifulSoup
 
+            res = self._get_session().get(self.url, timeout=_timeout)
+            soup = BeautifulSoup(res.text, 'html.parser')
+            self._links = [link['href'] for link in soup.find_all('a', string="ZIP")]
+        return self._links
+
+    def _load_validators(self) -> Dict[str, Dict[str, str]]:
+        """Returns ETag and Last-Modified headers of downloaded zips"""
+        try:
+            with open(os.path.join(self.folder, _validators_filename), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _download_zip(self, href: str, validator: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        """Downloads one zip into temporary file and moves it into place when complete
+
+        :param href: link to zip from the index page
+        :param validator: ETag and Last-Modified headers of already downloaded zip
+        :return: new validator, or the old one if zip was not modified
+        """
+        name = href.rsplit('/', 1)[-1]
+        filename = os.path.join(self.folder, name)
+
+        headers = {}
+        if os.path.isfile(filename):
+            if validator is not None and validator.get('etag') is not None:
+                headers['If-None-Match'] = validator['etag']
+            if validator is not None and validator.get('last_modified') is not None:
+                headers['If-Modified-Since'] = validator['last_modified']
+            else:
+                from email.utils import formatdate
+                headers['If-Modified-Since'] = formatdate(os.path.getmtime(filename), usegmt=True)
+
+        with self._get_session().get(self.url + href, headers=headers, stream=True, timeout=_timeout) as res:
+            if res.status_code == 304:
+                return validator
+            res.raise_for_status()
+
+            # temporary file doesn't end with .zip, so its never parsed. Its name is unique for every running
+            # thread, and it's created by open, so it gets permissions from umask like other files
+            tmp_filename = os.path.join(self.folder, f".download-{name}.{os.getpid()}.{threading.get_ident()}.part")
+            try:
+                with open(tmp_filename, 'wb') as f:
+                    for chunk in res.iter_content(chunk_size=_chunk_size):
+                        f.write(chunk)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+
+            return {'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified')}
+
+    @timed("download.download_data")
+    def download_data(self):
+        """Downloads all missing zips with data and revalidates already downloaded ones"""
         try:
             os.mkdir(self.folder)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
 
-        for link in soup.find_all('a', string="ZIP"):
-            name = link['href'].rsplit('/', 1)[-1]
+        validators = self._load_validators()
+        to_download = []
+        for href in self._zip_links():
+            name = href.rsplit('/', 1)[-1]
+            if name in self._checked:
+                continue
+            if os.path.isfile(os.path.join(self.folder, name)) and not self.revalidate:
+                continue
+            to_download.append(href)
 
-            filename = os.path.join(self.folder, name)
+        if len(to_download) == 0:
+            return
 
-            if os.path.isfile(filename):
-                continue
+        with ThreadPoolExecutor(max_workers=max(self.download_workers, 1)) as executor:
+            names = [href.rsplit('/', 1)[-1] for href in to_download]
+            futures = [executor.submit(self._download_zip, href, validators.get(name))
+                       for href, name in zip(to_download, names)]
+            try:
+                for name, future in zip(names, futures):
+                    validator = future.result()
+                    if validator is not None:
+                        validators[name] = validator
+                    self._checked.add(name)
+            finally:
+                with open(os.path.join(self.folder, _validators_filename), 'w', encoding='utf-8') as f:
+                    json.dump(validators, f)
 
-            file_url = self.url + link['href']
-            file = requests.get(file_url, headers={'User-Agent': 'Mozilla 5.0'})
+    def _sorted_zips(self) -> List[str]:
+        """Returns names of downloaded zips sorted from newest to oldest"""
+        # ignore caches and unfinished downloads
+        zips = list(filter(lambda x: x.endswith('.zip'), os.listdir(self.folder)))
+        return sorted(zips, key=_zip_sort_key, reverse=True)
 
-            f = open(filename, 'wb')
-            f.write(file.content)
+    def _zip_sources(self) -> Dict[str, List[int]]:
+        """Returns size and modification time of every downloaded zip, from newest to oldest"""
+        sources = {}
+        for file in self._sorted_zips():
+            stat = os.stat(os.path.join(self.folder, file))
+            sources[file] = [stat.st_size, stat.st_mtime_ns]
+        return sources
 
     def parse_region_data(self, region: str) -> Tuple[List[str], List[np.ndarray]]:
         """Returns parsed data for one region.
 
         :param region: region to parse
         """
-        parsed_data = []
-        parsed_ids = set()
+        return self.parse_regions_data([region])[region]
+
+    def parse_regions_data(self, regions: List[str],
+                           date_range: DateRange = None) -> Dict[str, Tuple[List[str], List[np.ndarray]]]:
+        """Returns parsed data for multiple regions, reading every zip only once.
 
+        :param regions: regions to parse
+        :param date_range: first and last day of accidents to parse, zips outside of range are skipped
+        """
         self.download_data()
 
-        # sort files from newest to oldest
-        pat = re.compile(r"(\d{2})?-?(\d{4})")
+        return self._parse_zips(regions, date_range=date_range)
 
-        def sort_fn(x):
-            date = pat.search(x)
-            month, year = date.group(1), date.group(2)
-            # this way, if no month is found in filename, file will have priority
-            if month is None:
-                return int(year) * 100 + 13
-            else:
-                return int(year) * 100 + int(month)
+    def _parse_zips(self, regions: List[str], zips: List[str] = None,
+                    date_range: DateRange = None) -> Dict[str, Tuple[List[str], List[np.ndarray]]]:
+        """Parses already downloaded zips for multiple regions.
+
+        :param regions: regions to parse
+        :param zips: zips to parse. If its None, parses all downloaded zips
+        :param date_range: first and last day of accidents to parse, zips outside of range are skipped
+        """
+        files = {_region_to_file[region]: region for region in regions}
+        # typed column chunks, raw rows are converted after every member, so they never pile up
+        parsed_data = {region: [] for region in regions}
+        # sorted ids of already parsed accidents
+        parsed_ids = {region: np.empty([0], dtype=np.int64) for region in regions}
+
+        if zips is None:
+            zips = self._sorted_zips()
+        else:
+            zips = sorted(zips, key=_zip_sort_key, reverse=True)
 
-        # ignore all pickles
-        zips = list(filter(lambda x: "zip" in x, os.listdir(self.folder)))
-        sorted_files = sorted(zips, key=sort_fn, reverse=True)
+        first, last = _normalize_date_range(date_range)
+        if date_range is not None:
+            zips = [file for file in zips if _zip_in_range(file, first, last)]
+        # iso dates can be compared as strings, before any conversion
+        first = str(first) if first is not None else None
+        last = str(last) if last is not None else None
 
-        for file in sorted_files:
+        for file in zips:
             fullpath = os.path.join(self.folder, file)
-            with ZipFile(fullpath, 'r') as archive:
-                with archive.open(_region_to_file[region]) as region_stats:
-                    region_stats = region_stats.read().decode('1250')
-                    for accident in region_stats.splitlines(keepends=False):
+            with span("download.read_zip"), ZipFile(fullpath, 'r') as archive:
+                for member in archive.namelist():
+                    if member not in files:
+                        continue
+                    region = files[member]
+                    region_data = []
+
+                    with archive.open(member) as region_stats:
+                        region_stats = region_stats.read().decode('1250')
+                    accidents = region_stats.splitlines(keepends=False)
+
+                    # only first occurrence of not yet parsed accident is kept
+                    ids = _id_column([accident.split(';', 1)[0] for accident in accidents])
+                    unique_ids, first_rows = np.unique(ids, return_index=True)
+                    unseen = ~_sorted_contains(parsed_ids[region], unique_ids)
+                    parsed_ids[region] = np.union1d(parsed_ids[region], unique_ids[unseen])
+
+                    for row in np.sort(first_rows[unseen]):
                         # for some reason, some stats have 65 columns, so ignore the last
-                        columns = accident.split(';')[:64]
-                        if columns[0] not in parsed_ids:
-                            parsed_ids.add(columns[0])
-                            # add region code
-                            columns.insert(0, region)
-                            parsed_data.append(columns)
-
-        numpy_arrays = []
-
-        types = list(map(lambda x: x[1], _data_header_types))
-        for x in range(65):
-            numpy_arrays.append(np.empty([len(parsed_data)], dtype=types[x]))
-
-        rows_with_default = [2, 3, 5] + [x for x in range(7, 35)] + [x for x in range(36, 46)]
-        rows_with_default_float = [46, 47, 48, 49, 50, 51]
-        rows_with_strip_str = [4, 6, 35, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 64]
-
-        for column, accident in enumerate(parsed_data):
-            for row, data in enumerate(accident):
-                if row in rows_with_default and data == "":
-                    data = -1
-                elif row in rows_with_strip_str:
-                    data = data.strip('"')
-                elif row in rows_with_default_float:
-                    data = data.strip('"')
-                    if len(data) == 0:
-                        data = float('nan')
-                    else:
-                        try:
-                            data = float(data.replace(',', '.'))
-                        except:
-                            data = float('nan')
-
-                numpy_arrays[row][column] = data
+                        columns = accidents[row].split(';')[:64]
+                        if date_range is not None:
+                            date = columns[3].strip('"')
+                            if (first is not None and date < first) or (last is not None and date > last):
+                                continue
+                        region_data.append(columns)
+                    del accidents
+
+                    with span("download.convert_columns", len(region_data)):
+                        parsed_data[region].append(_rows_to_columns(region, region_data, self.dictionary_encode))
+
+        header = list(map(lambda x: x[0], _data_header_types))
 
+        parsed = {}
+        for region in regions:
+            chunks = parsed_data.pop(region)
+            if len(chunks) == 0:
+                chunks = [_rows_to_columns(region, [], self.dictionary_encode)]
+            with span("download.merge_chunks", sum(len(chunk[0]) for chunk in chunks)):
+                parsed[region] = (header, _merge_columns(chunks))
+        return parsed
+
+    def _cache_path(self, region: str) -> str:
+        """Returns path to pickle cache file of region
+
+        :param region: region of cache file
+        """
+        return os.path.join(self.folder, self.cache_filename.format(region))
+
+    def _columns_path(self, region: str) -> str:
+        """Returns path to memory mapped cache directory of region
+
+        :param region: region of cache directory
+        """
+        return os.path.join(self.folder, self.cache_dirname.format(region))
+
+    def _sources_path(self, region: str, cache_format: str) -> str:
+        """Returns path to file with zips the cache of region was built from
+
+        :param region: region of cache
+        :param cache_format: format of cache
+        """
+        return os.path.join(self.folder, _sources_filename.format(region, cache_format))
+
+    def _stored_format(self, region: str) -> str:
+        """Returns format of cache which is loaded for region, mmap cache is used only when its already written
+
+        :param region: region of cache
+        """
+        if self.cache_format == "mmap" and os.path.isfile(os.path.join(self._columns_path(region), _manifest_name)):
+            return "mmap"
+        return "pickle"
+
+    def _load_sources(self, region: str) -> Optional[Dict[str, List[int]]]:
+        """Returns zips the loaded cache of region was built from, or None for cache without this information
+
+        :param region: region of cache
+        """
+        try:
+            with open(self._sources_path(region, self._stored_format(region)), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _has_cache(self, region: str) -> bool:
+        """Returns true if region has cache in any format
+
+        :param region: region to check
+        """
+        if self.cache_format == "mmap" and os.path.isfile(os.path.join(self._columns_path(region), _manifest_name)):
+            return True
+        # old pickle cache can be migrated
+        return os.path.isfile(self._cache_path(region))
+
+    @timed("download.load_cache")
+    def _load_cache(self, region: str) -> Tuple[List[str], List[np.ndarray]]:
+        """Loads parsed region data from cache
+
+        :param region: region to load
+        """
+        if self.cache_format == "mmap":
+            path = self._columns_path(region)
+            if os.path.isfile(os.path.join(path, _manifest_name)):
+                header, columns = _read_columns(path)
+                return header, _encode_columns(columns, self.dictionary_encode)
+
+        with gzip.open(self._cache_path(region), 'rb') as cache:
+            header, columns = pickle.load(cache)
+        region_data = (header, _encode_columns(columns, self.dictionary_encode))
+
+        if self.cache_format == "mmap":
+            # migrate old cache, so next load is mapped, it is built from the same zips
+            self._write_cache(region, region_data, self._load_sources(region))
+        return region_data
+
+    @timed("download.write_cache")
+    def _write_cache(self, region: str, region_data: Tuple[List[str], List[np.ndarray]],
+                     sources: Dict[str, List[int]] = None):
+        """Writes parsed region data into cache
+
+        :param region: region to write
+        :param region_data: parsed data of region
+        :param sources: zips the data was parsed from. If its None, sources are left unchanged
+        """
+        if self.cache_format == "mmap":
+            _write_columns(self._columns_path(region), region_data)
+        else:
+            with gzip.open(self._cache_path(region), 'wb') as cache:
+                pickle.dump(region_data, cache)
+
+        index = _build_index(region_data[1][1])
+        self._save_index(self._index_path(region, self.cache_format), index)
+        self._indexes[region] = index
+
+        if sources is not None:
+            with open(self._sources_path(region, self.cache_format), 'w', encoding='utf-8') as f:
+                json.dump(sources, f)
+
+    def _index_path(self, region: str, cache_format: str) -> str:
+        """Returns path to id index of region
+
+        :param region: region of index
+        :param cache_format: format of cache the index points into
+        """
+        return os.path.join(self.folder, _index_filename.format(region, cache_format))
+
+    @staticmethod
+    def _save_index(path: str, index: np.ndarray):
+        """Writes index through temporary file, so index is never incomplete
+
+        :param path: file to write to
+        :param index: index made by _build_index
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp_path, path)
+
+    def _get_index(self, region: str) -> np.ndarray:
+        """Returns id index of cached region, first row are sorted ids, second row their positions in data
+
+        :param region: region in program cache
+        """
+        if region not in self._indexes:
+            path = self._index_path(region, self._stored_format(region))
+            ids = self.cache[region][1][1]
+            index = np.load(path, mmap_mode='r') if os.path.isfile(path) else None
+            if index is None or index.shape[1] != len(ids):
+                # cache without index, or index of other data, so build it again
+                index = _build_index(ids)
+                self._save_index(path, index)
+            self._indexes[region] = index
+        return self._indexes[region]
+
+    def _update_cache(self, regions: List[str], sources: Dict[str, List[int]], zips: List[str]):
+        """Parses only new zips and merges them with cached regions. Result matches full parse of all zips
+        only if new zips are newer than all zips the cache is built from.
+
+        :param regions: regions in program cache to update
+        :param sources: all zips the updated cache is built from
+        :param zips: new zips to parse
+        """
+        for region, (header, new_columns) in self._parse_zips(regions, zips).items():
+            old_columns = self.cache[region][1]
+            # zips are cumulative, so full parse takes every row of new zips first and then cached rows
+            # of accidents missing in them, both in their original order
+            new_ids = np.sort(_id_column(new_columns[1]))
+            kept = ~_sorted_contains(new_ids, _id_column(old_columns[1]))
+            columns = _merge_columns([new_columns, [column[kept] for column in old_columns]])
+
+            self.cache[region] = (header, columns)
+            self._write_cache(region, self.cache[region], sources)
+
+    @timed("download.fill_cache")
+    def _fill_cache(self, regions: List[str], workers: int = 1, refresh: bool = False, offline: bool = False):
+        """Loads or parses selected regions into program cache
+
+        Cached regions are updated with zips downloaded after the cache was built.
+
+        :param regions: regions to load
+        :param workers: number of processes used to parse regions missing in cache. If its None, uses all cpus
+        :param refresh: download new zips first and reparse cache without information about its zips
+        :param offline: never download, regions missing in cache are parsed from already downloaded zips
+        """
+        if refresh and offline:
+            raise ValueError("refresh needs to download, so it can't be used offline")
+        if refresh:
+            self.download_data()
+        current = self._zip_sources() if os.path.isdir(self.folder) else {}
+
+        to_parse = []
+        to_update = {}
+        for region in regions:
+            if region in self.cache.keys() or region in to_parse:
+                continue
+
+            if not self._has_cache(region):
+                to_parse.append(region)
+                continue
+
+            sources = self._load_sources(region)
+            if sources is None:
+                if refresh:
+                    to_parse.append(region)
+                else:
+                    self.cache[region] = self._load_cache(region)
+                continue
+
+            if any(current.get(file) != stats for file, stats in sources.items()):
+                # some zip was changed or removed, so old data can't be trusted
+                to_parse.append(region)
+                continue
+
+            new_zips = tuple(file for file in current if file not in sources)
+            newest = max(map(_zip_sort_key, sources), default=0)
+            if any(_zip_sort_key(file) < newest for file in new_zips):
+                # update puts new rows first, which matches full parse only if new zips are newer than cached ones
+                to_parse.append(region)
+                continue
+
+            self.cache[region] = self._load_cache(region)
+            if len(new_zips) > 0:
+                to_update.setdefault(new_zips, []).append(region)
+
+        for new_zips, update_regions in to_update.items():
+            self._update_cache(update_regions, current, list(new_zips))
+
+        if len(to_parse) > 0:
+            if not refresh and not offline:
+                self.download_data()
+            if offline and (not os.path.isdir(self.folder) or len(self._sorted_zips()) == 0):
+                raise FileNotFoundError(f"no cached data or downloaded zips for regions {to_parse} in '{self.folder}'")
+            sources = self._zip_sources()
+
+            if workers is None:
+                workers = os.cpu_count()
+            workers = min(workers, len(to_parse))
+
+            if workers > 1:
+                # every worker reads the zips once for its share of regions
+                groups = [to_parse[i::workers] for i in range(workers)]
+                args = self._worker_args()
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_parse_to_cache, args, group, sources) for group in groups]
+                    for future in futures:
+                        self.cache.update(future.result())
+            else:
+                for region, region_data in self._parse_zips(to_parse).items():
+                    self.cache[region] = region_data
+                    self._write_cache(region, region_data, sources)
+
+    def _select(self, regions: List[str], columns: List[str] = None,
+                date_range: DateRange = None) -> Tuple[List[str], List[List[np.ndarray]]]:
+        """Returns selected columns and rows of cached regions
+
+        :param regions: regions to return
+        :param columns: names of columns to return. If its None, returns all columns
+        :param date_range: first and last day of accidents to return
+        """
         header = list(map(lambda x: x[0], _data_header_types))
+        if columns is None:
+            indices = list(range(len(header)))
+        else:
+            for name in columns:
+                if name not in header:
+                    raise ValueError(f"unknown column '{name}'")
+            indices = [header.index(name) for name in columns]
+
+        first, last = _normalize_date_range(date_range)
+        parts = []
+        for region in regions:
+            region_columns = self.cache[region][1]
+            if date_range is None:
+                parts.append([region_columns[x] for x in indices])
+                continue
+
+            # only date column is read to filter rows
+            dates = region_columns[4]
+            mask = np.ones([len(dates)], dtype=bool)
+            if first is not None:
+                mask &= dates >= first
+            if last is not None:
+                mask &= dates <= last
+            parts.append([region_columns[x][mask] for x in indices])
+
+        return [header[x] for x in indices], parts
+
+    def _may_contain(self, region: str, ids: np.ndarray, current: Dict[str, List[int]]) -> bool:
+        """Returns false only if persisted index of up to date cache proves that region has none of ids
+
+        :param region: region to check
+        :param ids: searched ids
+        :param current: sources of downloaded zips
+        """
+        if region in self.cache or not self._has_cache(region):
+            return True
+        sources = self._load_sources(region)
+        if sources is not None and sources != current:
+            # cache will be updated, so its index is not complete
+            return True
+        path = self._index_path(region, self._stored_format(region))
+        if not os.path.isfile(path):
+            return True
+        return bool(_sorted_contains(np.load(path, mmap_mode='r')[0], ids).any())
+
+    def find_accidents(self, accident_ids: List[Union[str, int]], regions: List[str] = None,
+                       offline: bool = False) -> Tuple[List[str], List[np.ndarray]]:
+        """Returns accidents with given ids, found through id index without scanning the data.
+
+        Persisted indexes are searched first and only regions with some of the ids are loaded.
+        Regions without cache or index are loaded like in get_list.
+        Accidents are returned in order of given ids, ids which are not found are skipped.
+
+        :param accident_ids: ids of accidents to find
+        :param regions: regions to search in. If its None, searches all regions
+        :param offline: only use cache and already downloaded zips, index page is never fetched
+        """
+        header = list(map(lambda x: x[0], _data_header_types))
+
+        if regions is None:
+            regions = list(_region_to_file.keys())
+
+        ids = _id_column(accident_ids)
+        current = self._zip_sources() if os.path.isdir(self.folder) else {}
+        regions = [region for region in regions if self._may_contain(region, ids, current)]
+        self._fill_cache(regions, offline=offline)
+
+        order = []
+        parts = []
+        for region in regions:
+            index = self._get_index(region)
+            found = _sorted_contains(index[0], ids)
+            if not found.any():
+                continue
+            rows = index[1][np.searchsorted(index[0], ids[found])]
+            order.append(np.flatnonzero(found))
+            parts.append([column[rows] for column in self.cache[region][1]])
+
+        if len(parts) == 0:
+            return header, _rows_to_columns('', [], self.dictionary_encode)
+        columns = _merge_columns(parts)
+        # restore order of given ids
+        order = np.argsort(np.concatenate(order), kind='stable')
+        return header, [column[order] for column in columns]
+
+    def find_accident(self, accident_id: Union[str, int], regions: List[str] = None,
+                      offline: bool = False) -> Optional[Dict[str, object]]:
+        """Returns accident with given id as mapping of column names to values, or None if its not found
 
-        return header, numpy_arrays
+        :param accident_id: id of accident to find
+        :param regions: regions to search in. If its None, searches all regions
+        :param offline: only use cache and already downloaded zips, index page is never fetched
+        """
+        header, columns = self.find_accidents([accident_id], regions, offline)
+        if len(columns[0]) == 0:
+            return None
+        return {name: column[0] for name, column in zip(header, columns)}
+
+    def get_regions(self, regions: List[str] = None, workers: int = 1, refresh: bool = False, columns: List[str] = None,
+                    date_range: DateRange = None, offline: bool = False) -> Tuple[List[str], Dict[str, List[np.ndarray]]]:
+        """Returns parsed data for selected regions, without merging them together.
 
-    def get_list(self, regions: List[str] = None) -> Tuple[List[str], List[np.ndarray]]:
+        Returned arrays are shared with program cache, so nothing is copied, but they must not be modified.
+
+        :param regions: regions to return. If its None, returns all regions
+        :param workers: number of processes used to parse regions missing in cache. If its None, uses all cpus
+        :param refresh: download new zips and add their accidents to cache
+        :param columns: names of columns to return. If its None, returns all columns
+        :param date_range: first and last day of accidents to return, None means unbounded
+        :param offline: only use cache and already downloaded zips, index page is never fetched
+        """
+        if regions is None:
+            regions = list(_region_to_file.keys())
+
+        self._fill_cache(regions, workers, refresh, offline)
+
+        header, parts = self._select(regions, columns, date_range)
+        return header, dict(zip(regions, parts))
+
+    def get_list(self, regions: List[str] = None, workers: int = 1, refresh: bool = False, columns: List[str] = None,
+                 date_range: DateRange = None, offline: bool = False) -> Tuple[List[str], List[np.ndarray]]:
         """Returns parsed data for selected regions.
 
         :param regions: regions to return. If its None, returns all regions
+        :param workers: number of processes used to parse regions missing in cache. If its None, uses all cpus
+        :param refresh: download new zips and add their accidents to cache
+        :param columns: names of columns to return. If its None, returns all columns
+        :param date_range: first and last day of accidents to return, None means unbounded
+        :param offline: only use cache and already downloaded zips, index page is never fetched
         """
-        header = list(map(lambda x: x[0], _data_header_types))
-        data = (header, [])
+        if regions is None:
+            regions = list(_region_to_file.keys())
+
+        self._fill_cache(regions, workers, refresh, offline)
+
+        with span("download.merge") as merge_span:
+            header, parts = self._select(regions, columns, date_range)
+            merged = _merge_columns(parts)
+            merge_span.rows = len(merged[0]) if len(merged) > 0 else 0
+        return header, merged
 
+    def iter_batches(self, regions: List[str] = None, batch_rows: int = _batch_rows, by_month: bool = False,
+                     columns: List[str] = None, date_range: DateRange = None, workers: int = 1,
+                     offline: bool = False) -> Iterator[Batch]:
+        """Yields data of selected regions in batches of at most batch_rows rows, straight from cache.
+
+        Only one region is held in program cache at a time, with mmap cache format batches are views of cache
+        files, so memory use doesn't grow with number of regions. Regions missing in cache are parsed first,
+        a group of at most workers regions at a time.
+
+        :param regions: regions to return. If its None, returns all regions
+        :param batch_rows: maximum number of rows in one batch
+        :param by_month: if true, every batch contains accidents of a single month
+        :param columns: names of columns to return. If its None, returns all columns
+        :param date_range: first and last day of accidents to return, None means unbounded
+        :param workers: number of processes used to parse regions missing in cache. If its None, uses all cpus
+        :param offline: only use cache and already downloaded zips, index page is never fetched
+        """
+        if batch_rows < 1:
+            raise ValueError("batch_rows must be positive")
         if regions is None:
             regions = list(_region_to_file.keys())
 
+        missing = [region for region in regions if region not in self.cache and not self._has_cache(region)]
+        # missing regions are parsed and written in groups, one region per worker, so only one group is in memory
+        group_size = max(workers if workers is not None else os.cpu_count(), 1)
+        for start in range(0, len(missing), group_size):
+            group = missing[start:start + group_size]
+            self._fill_cache(group, workers, offline=offline)
+            for region in group:
+                del self.cache[region]
+                self._indexes.pop(region, None)
+
+        first, last = _normalize_date_range(date_range)
         for region in regions:
-            # add data to program cache
-            if region not in self.cache.keys():
-                cached_file = os.path.join(self.folder, self.cache_filename.format(region))
+            kept = region in self.cache
+            self._fill_cache([region], workers, offline=offline)
+            header, parts = self._select([region], columns)
+            region_columns = parts[0]
+            dates = self.cache[region][1][4]
+
+            if by_month:
+                # rows are grouped by month through stable sort of positions, columns are only copied per batch
+                months = dates.astype('datetime64[M]')
+                order = np.argsort(months, kind='stable')
+                bounds = np.flatnonzero(months[order][1:] != months[order][:-1]) + 1
+                groups = [(months[order[start]], order[start:stop])
+                          for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(order)]) if stop > start]
+            else:
+                groups = [(None, slice(start, min(start + batch_rows, len(dates))))
+                          for start in range(0, len(dates), batch_rows)]
 
-                if os.path.isfile(cached_file):
-                    cache = gzip.open(cached_file, 'rb')
-                    self.cache[region] = pickle.load(cache)
+            for month, rows in groups:
+                if by_month:
+                    chunks = [rows[start:start + batch_rows] for start in range(0, len(rows), batch_rows)]
                 else:
-                    self.cache[region] = self.parse_region_data(region)
+                    chunks = [rows]
+                for chunk in chunks:
+                    mask = None
+                    if first is not None or last is not None:
+                        chunk_dates = dates[chunk]
+                        mask = np.ones([len(chunk_dates)], dtype=bool)
+                        if first is not None:
+                            mask &= chunk_dates >= first
+                        if last is not None:
+                            mask &= chunk_dates <= last
+                        if not mask.any():
+                            continue
+                    batch = [column[chunk] for column in region_columns]
+                    if mask is not None and not mask.all():
+                        batch = [column[mask] for column in batch]
+                    yield region, month, header, batch
 
-                    cache = gzip.open(cached_file, 'wb')
-                    pickle.dump(self.cache[region], cache)
+            if not kept:
+                # region is released, so memory holds only one region
+                del self.cache[region]
+                self._indexes.pop(region, None)
 
-            # add to output
-            if len(data[1]) == 0:
-                data = (header, self.cache[region][1])
-            else:
-                for x in range(65):
-                    data[1][x] = np.append(data[1][x], self.cache[region][1][x])
-        return data
+
+def _parse_to_cache(args: Dict, regions: List[str],
+                    sources: Dict[str, List[int]]) -> Dict[str, Tuple[List[str], List[np.ndarray]]]:
+    """Parses regions from already downloaded zips and writes their cache files, used by worker processes
+
+    :param args: arguments for DataDownloader constructor
+    :param regions: regions to parse
+    :param sources: zips the cache is built from
+    """
+    downloader = DataDownloader(**args)
+    parsed = downloader._parse_zips(regions)
+    for region, region_data in parsed.items():
+        downloader._write_cache(region, region_data, sources)
+    return parsed
 
 
 if __name__ == "__main__":
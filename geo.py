@@ -1,14 +1,29 @@
 import os
 import errno
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Tuple
 import pandas as pd
 import geopandas
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, Normalize
 import contextily
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import numpy as np
+import pyproj
+from scipy.spatial import cKDTree
+
+from instrument import span, timed
 
 _reg = 'MSK'
 _map_src = contextily.providers.Stamen.TonerLite
+_projection_cache_suffix = ".geo.pkl"
+_cache_keys = ('ids', 'd', 'e', 'x', 'y')
+_cluster_methods = ("grid", "minibatch", "full")
+_index_cache_suffix = ".kdtree.pkl"
+_plot_modes = ("points", "raster")
+_dpi = 200
 
 
 def _save_and_show(fig_location: str, show_figure: bool):
@@ -27,42 +42,216 @@ def _save_and_show(fig_location: str, show_figure: bool):
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
-        plt.savefig(fig_location, dpi=200)
+        with span("savefig"):
+            plt.savefig(fig_location, dpi=_dpi)
 
     if show_figure:
         plt.show()
 
 
-def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
+def _load_projection(cache_file: str) -> dict:
+    """
+     Loads cached projection, arrays in it are sorted by accident id
+
+     :param cache_file: file with cached projection
+     :return: dictionary with arrays ids, d, e, x, y, or None if file doesn't exist or is invalid
+    """
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    with open(cache_file, 'rb') as f:
+        cache = pickle.load(f)
+    if not isinstance(cache, dict) or any(key not in cache for key in _cache_keys):
+        return None
+    return cache
+
+
+def _save_pickle(cache_file: str, cache: dict):
+    """
+     Saves cache into file, through temporary file so readers never see partial cache.
+     Cache is only an optimization, so if file can't be written (e.g. read-only folder), nothing is saved.
+
+     :param cache_file: file to save to
+     :param cache: dictionary to save
+    """
+    tmp_filename = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, cache_file)
+    except OSError:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def _project(d: np.ndarray, e: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+     Projects S-JTSK coordinates into web mercator
+
+     :param d: x coordinates in EPSG:5514
+     :param e: y coordinates in EPSG:5514
+     :return: x and y coordinates in EPSG:3857
+    """
+    transformer = pyproj.Transformer.from_crs("EPSG:5514", "EPSG:3857", always_xy=True)
+    x, y = transformer.transform(d, e)
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+@timed("geo.make_geo")
+def make_geo(df: pd.DataFrame, cache_file: str = None) -> geopandas.GeoDataFrame:
     """
      Converts DataFrame into valid GeoDataFrame
 
      :param df: input DataFrame
+     :param cache_file: file to keep projected coordinates in. Accidents with unchanged id and coordinates are
+      taken from it and only the rest is projected. If its None, all coordinates are projected
      :return: converted GeoDataFrame
     """
 
     df = df[(df.d.notnull()) & (df.e.notnull())]
+    # ids are only needed as key of cache
+    ids = np.asarray(df.p1, dtype=np.int64) if cache_file is not None else None
     df = df[['p5a', 'd', 'e', 'region']]
-    gdf = geopandas.GeoDataFrame(df, geometry=geopandas.points_from_xy(df.d, df.e), crs="EPSG:5514")
-    gdf = gdf.to_crs(epsg=3857)
-    return gdf
+    d = np.asarray(df.d, dtype=np.float64)
+    e = np.asarray(df.e, dtype=np.float64)
+    x = np.empty([len(df)], dtype=np.float64)
+    y = np.empty([len(df)], dtype=np.float64)
+
+    cache = _load_projection(cache_file)
+    missing = np.ones([len(df)], dtype=bool)
+    if cache is not None and len(cache['ids']) > 0:
+        positions = np.minimum(np.searchsorted(cache['ids'], ids), len(cache['ids']) - 1)
+        # coordinates are part of key, so corrected accidents are projected again
+        found = (cache['ids'][positions] == ids) & (cache['d'][positions] == d) & (cache['e'][positions] == e)
+        x[found] = cache['x'][positions[found]]
+        y[found] = cache['y'][positions[found]]
+        missing = ~found
+
+    with span("geo.project", int(missing.sum())):
+        x[missing], y[missing] = _project(d[missing], e[missing])
+
+    if cache_file is not None and (cache is None or missing.any()):
+        # new rows go first, so they replace old rows with same id
+        merged = {key: value[missing] for key, value in zip(_cache_keys, (ids, d, e, x, y))}
+        if cache is not None:
+            merged = {key: np.concatenate([merged[key], cache[key]]) for key in _cache_keys}
+        _, first = np.unique(merged['ids'], return_index=True)
+        _save_pickle(cache_file, {key: value[first] for key, value in merged.items()})
+
+    return geopandas.GeoDataFrame(df, geometry=geopandas.points_from_xy(x, y), crs="EPSG:3857")
+
+
+def _raster_grid(points: np.ndarray, ax: plt.Axes) -> Tuple[Tuple[float, float, float, float], float]:
+    """
+     Chooses raster covering all points with about one square cell per output pixel of axes
+
+     :param points: array of shape (n, 2) with x and y coordinates
+     :param ax: axes the raster is drawn into
+     :return: extent (left, right, bottom, top) and size of cell side
+    """
+    if len(points) == 0:
+        return (0.0, 1.0, 0.0, 1.0), 1.0
+    left, bottom = points.min(axis=0)
+    right, top = points.max(axis=0)
+    position = ax.get_position()
+    width, height = ax.figure.get_size_inches()
+    pixels_x = max(int(position.width * width * _dpi), 1)
+    pixels_y = max(int(position.height * height * _dpi), 1)
+    cell = max((right - left) / pixels_x, (top - bottom) / pixels_y)
+    if cell <= 0:
+        cell = 1.0
+    return (left, right, bottom, top), cell
 
 
-def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
+def _density_raster(points: np.ndarray, layers: np.ndarray, n_layers: int,
+                    extent: Tuple[float, float, float, float], cell: float) -> np.ndarray:
+    """
+     Counts points in raster cells, all layers are counted in one pass
+
+     :param points: array of shape (n, 2) with x and y coordinates
+     :param layers: layer of every point, points with layer outside of 0..n_layers-1 are skipped
+     :param n_layers: number of layers
+     :param extent: left, right, bottom and top border of raster
+     :param cell: size of cell side
+     :return: array of counts with shape (n_layers, rows, columns), first row is at bottom
+    """
+    left, right, bottom, top = extent
+    columns = int(np.floor((right - left) / cell)) + 1
+    rows = int(np.floor((top - bottom) / cell)) + 1
+
+    valid = (layers >= 0) & (layers < n_layers)
+    column = np.clip(((points[valid, 0] - left) / cell).astype(np.int64), 0, columns - 1)
+    row = np.clip(((points[valid, 1] - bottom) / cell).astype(np.int64), 0, rows - 1)
+    cells = (layers[valid].astype(np.int64) * rows + row) * columns + column
+    return np.bincount(cells, minlength=n_layers * rows * columns).reshape(n_layers, rows, columns)
+
+
+def _draw_raster(ax: plt.Axes, counts: np.ndarray, extent: Tuple[float, float, float, float], cell: float,
+                 cmap: str, log: bool, overlay: bool):
+    """
+     Draws counts of one layer as single image
+
+     :param ax: axes to draw into
+     :param counts: counts made by _density_raster for one layer
+     :param extent: left, right, bottom and top border of raster
+     :param cell: size of cell side
+     :param cmap: name of colormap
+     :param log: if true, colors are in log scale
+     :param overlay: if true, raster is drawn over basemap, otherwise under it
+    """
+    left, _, bottom, _ = extent
+    rows, columns = counts.shape
+    # empty cells are transparent, so basemap is visible there
+    image = np.ma.masked_equal(counts, 0)
+    vmax = max(int(counts.max()), 1)
+    norm = LogNorm(vmin=1, vmax=max(vmax, 2)) if log else Normalize(vmin=0, vmax=vmax)
+    ax.imshow(image, extent=(left, left + columns * cell, bottom, bottom + rows * cell), origin='lower',
+              cmap=cmap, norm=norm, interpolation='nearest', zorder=2 if overlay else 0)
+
+
+def _basemap_args(mode: str, overlay: bool) -> dict:
+    """
+     Returns extra arguments of basemap, so raster drawn under it stays visible
+
+     :param mode: plot mode
+     :param overlay: if true, raster is drawn over basemap
+    """
+    if mode == "raster" and not overlay:
+        return {'zorder': 1, 'alpha': 0.5}
+    return {}
+
+
+@timed("geo.plot_geo")
+def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False,
+             mode: str = "points", log: bool = True, overlay: bool = True):
     """
     Draws two graphs with accident locations
 
     :param gdf: data source
     :param fig_location: file to save to
     :param show_figure: show figure on screen
+    :param mode: points to draw every accident as marker, raster to draw density of accidents as one image
+    :param log: if true, raster colors are in log scale
+    :param overlay: if true, raster is drawn over basemap, otherwise under it
     """
+    if mode not in _plot_modes:
+        raise ValueError(f"unknown plot mode {mode}, expected one of {_plot_modes}")
 
     gdf = gdf[gdf.region == _reg]
     fig, ax = plt.subplots(1, 2)
     fig.set_size_inches((16, 8))
 
-    gdf[gdf.p5a == 1].plot(ax=ax[0], markersize=2, color='red')
-    gdf[gdf.p5a == 2].plot(ax=ax[1], markersize=2, color='green')
+    if mode == "raster":
+        # both panels come from one binning pass over shared grid
+        with span("geo.raster", len(gdf)):
+            points = _coordinates(gdf)
+            layers = np.select([gdf.p5a.to_numpy() == 1, gdf.p5a.to_numpy() == 2], [0, 1], -1)
+            extent, cell = _raster_grid(points, ax[0])
+            counts = _density_raster(points, layers, 2, extent, cell)
+        _draw_raster(ax[0], counts[0], extent, cell, 'Reds', log, overlay)
+        _draw_raster(ax[1], counts[1], extent, cell, 'Greens', log, overlay)
+    else:
+        gdf[gdf.p5a == 1].plot(ax=ax[0], markersize=2, color='red')
+        gdf[gdf.p5a == 2].plot(ax=ax[1], markersize=2, color='green')
 
     # visuals
     ax[0].set_axis_off()
@@ -70,43 +259,311 @@ def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure:
     ax[0].set(title='Nehody v MSK kraji v obci')
     ax[1].set(title='Nehody v MSK kraji mimo obec')
     fig.set_tight_layout(True)
-    contextily.add_basemap(ax[0], source=_map_src, crs=gdf.crs.to_string())
-    contextily.add_basemap(ax[1], source=_map_src, crs=gdf.crs.to_string())
+    with span("geo.basemap"):
+        contextily.add_basemap(ax[0], source=_map_src, crs=gdf.crs.to_string(), **_basemap_args(mode, overlay))
+        contextily.add_basemap(ax[1], source=_map_src, crs=gdf.crs.to_string(), **_basemap_args(mode, overlay))
 
     _save_and_show(fig_location, show_figure)
 
 
-def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
+def _coordinates(gdf: geopandas.GeoDataFrame) -> np.ndarray:
+    """
+     Returns coordinates of point geometries as array of shape (n, 2)
+
+     :param gdf: GeoDataFrame with point geometries
+    """
+    return np.stack([gdf.geometry.x.to_numpy(dtype=np.float64), gdf.geometry.y.to_numpy(dtype=np.float64)], axis=1)
+
+
+def _coordinates_fingerprint(points: np.ndarray) -> str:
+    """
+     Returns hash of coordinates, used as key of persistent index
+
+     :param points: array of shape (n, 2) with x and y coordinates
+    """
+    return hashlib.sha256(np.ascontiguousarray(points).tobytes()).hexdigest()
+
+
+class SpatialIndex:
+    """KD-tree over projected accident points, all queries return row positions into indexed frame (for iloc)"""
+    def __init__(self, points: np.ndarray):
+        """
+        :param points: array of shape (n, 2) with x and y coordinates, in order of frame rows
+        """
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.tree = cKDTree(self.points)
+        self.fingerprint = _coordinates_fingerprint(self.points)
+
+    @classmethod
+    def from_geo(cls, gdf: geopandas.GeoDataFrame, cache_file: str = None) -> 'SpatialIndex':
+        """
+        Creates index of GeoDataFrame made by make_geo
+
+        :param gdf: indexed data, coordinates are in its CRS (meters for EPSG:3857)
+        :param cache_file: file to keep index in. Index is loaded from it while coordinates in gdf are unchanged
+        """
+        points = _coordinates(gdf)
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                index = pickle.load(f)
+            if isinstance(index, cls) and index.fingerprint == _coordinates_fingerprint(points):
+                return index
+
+        with span("geo.build_index", len(points)):
+            index = cls(points)
+        if cache_file is not None:
+            _save_pickle(cache_file, index)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def bbox(self, min_x, min_y, max_x, max_y):
+        """
+        Finds points inside of bounding boxes, borders included
+
+        :param min_x: left border, number or array for batched query
+        :param min_y: bottom border
+        :param max_x: right border
+        :param max_y: top border
+        :return: sorted positions of points, list of them for batched query
+        """
+        boxes = np.broadcast_arrays(*[np.asarray(value, dtype=np.float64) for value in (min_x, min_y, max_x, max_y)])
+        batched = boxes[0].ndim > 0
+        boxes = np.stack([box.ravel() for box in boxes], axis=1)
+
+        # candidates are inside of square around box, rest is filtered exactly
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        radii = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) / 2
+        candidates = self.tree.query_ball_point(centers, radii, p=np.inf, return_sorted=True)
+
+        result = []
+        for box, found in zip(boxes, candidates):
+            found = np.asarray(found, dtype=np.int64)
+            points = self.points[found]
+            inside = ((points[:, 0] >= box[0]) & (points[:, 0] <= box[2]) &
+                      (points[:, 1] >= box[1]) & (points[:, 1] <= box[3]))
+            result.append(found[inside])
+        return result if batched else result[0]
+
+    def radius(self, x, y, r):
+        """
+        Finds points within distance from given points
+
+        :param x: x coordinate of query, number or array for batched query
+        :param y: y coordinate of query
+        :param r: distance, number or array with distance for every query
+        :return: sorted positions of points, list of them for batched query
+        """
+        x, y, r = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                      np.asarray(r, dtype=np.float64))
+        batched = x.ndim > 0
+        found = self.tree.query_ball_point(np.stack([x.ravel(), y.ravel()], axis=1), r.ravel(), return_sorted=True)
+        result = [np.asarray(positions, dtype=np.int64) for positions in found]
+        return result if batched else result[0]
+
+    def nearest(self, x, y, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds k nearest points
+
+        :param x: x coordinate of query, number or array for batched query
+        :param y: y coordinate of query
+        :param k: number of points to find
+        :return: distances and positions of points, with shape (k,) or (queries, k) for batched query.
+         Missing neighbours have infinite distance and position equal to number of points
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        distances, positions = self.tree.query(np.stack([x.ravel(), y.ravel()], axis=1), k=[i + 1 for i in range(k)])
+        positions = positions.astype(np.int64)
+        if x.ndim == 0:
+            return distances[0], positions[0]
+        return distances, positions
+
+
+def _grid_aggregate(points: np.ndarray, grid_size: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+     Aggregates points into square grid cells
+
+     :param points: array of shape (n, 2) with x and y coordinates
+     :param grid_size: size of cell side in units of coordinates
+     :return: mean position of points in every nonempty cell and number of points in it
+    """
+    cells = np.floor(points / grid_size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, 0]),
+                          np.bincount(inverse, weights=points[:, 1])], axis=1) / counts[:, None]
+    return centroids, counts
+
+
+def _cluster_points(points: np.ndarray, k: int, method: str, grid_size: float, seed: int) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+     Clusters points, used directly or in worker process
+
+     :param points: array of shape (n, 2) with x and y coordinates
+     :param k: number of clusters, less clusters are made if there are not enough points
+     :param method: grid to run weighted KMeans on grid cells, minibatch for MiniBatchKMeans on all points,
+      full for KMeans on all points
+     :param grid_size: size of grid cell side, only used by grid method
+     :param seed: random state of clustering
+     :return: cluster centres and number of points in every cluster
+    """
+    if len(points) == 0:
+        return np.empty([0, 2], dtype=np.float64), np.empty([0], dtype=np.int64)
+
+    if method == "grid":
+        # clustering runs on cells, so its runtime depends on covered area instead of number of points
+        samples, weights = _grid_aggregate(points, grid_size)
+    else:
+        samples, weights = points, np.ones([len(points)], dtype=np.int64)
+
+    n_clusters = min(k, len(samples))
+    if method == "minibatch":
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=4096, n_init=3)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=seed, n_init=10)
+    model.fit(samples, sample_weight=weights)
+
+    counts = np.bincount(model.labels_, weights=weights, minlength=n_clusters).astype(np.int64)
+    return model.cluster_centers_, counts
+
+
+def _cluster_fingerprint(name: str, points: np.ndarray, k: int, method: str, grid_size: float, seed: int) -> str:
+    """
+     Returns hash of clustered points and clustering parameters
+
+     :param name: name of group of points
+     :param points: array of shape (n, 2) with x and y coordinates
+     :return: hex digest, used as key of cluster cache
+    """
+    digest = hashlib.sha256(repr((name, k, method, grid_size, seed, points.shape)).encode())
+    digest.update(np.ascontiguousarray(points).tobytes())
+    return digest.hexdigest()
+
+
+@timed("geo.cluster_accidents")
+def cluster_accidents(gdf: geopandas.GeoDataFrame, k: int = 10, regions: Iterable[str] = None,
+                      per_region: bool = False, method: str = "grid", grid_size: float = 500.0,
+                      workers: int = 1, cache_file: str = None, seed: int = 0) -> geopandas.GeoDataFrame:
+    """
+     Finds clusters of accidents
+
+     :param gdf: data source made by make_geo
+     :param k: number of clusters, for every region if per_region is true
+     :param regions: regions to cluster. If its None, all regions in data are used
+     :param per_region: if true, every region is clustered separately, otherwise all selected points together
+     :param method: grid, minibatch or full, see _cluster_points
+     :param grid_size: size of grid cell side in units of gdf coordinates (meters for EPSG:3857)
+     :param workers: number of processes clustering regions in parallel
+     :param cache_file: file to keep results in, keyed by hash of points and parameters
+     :param seed: random state of clustering
+     :return: GeoDataFrame with columns region, counts and geometry of cluster centres, in CRS of gdf
+    """
+    if method not in _cluster_methods:
+        raise ValueError(f"unknown clustering method {method}, expected one of {_cluster_methods}")
+
+    if regions is None:
+        regions = sorted(gdf.region.unique())
+    regions = list(regions)
+    gdf = gdf[gdf.region.isin(regions)]
+
+    # groups of points clustered together
+    if per_region:
+        groups = [(region, gdf[gdf.region == region]) for region in regions]
+    else:
+        groups = [(",".join(regions), gdf)]
+    groups = [(name, np.stack([group.geometry.x.to_numpy(), group.geometry.y.to_numpy()], axis=1))
+              for name, group in groups]
+
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+
+    keys = [_cluster_fingerprint(name, points, k, method, grid_size, seed) for name, points in groups]
+    todo = [i for i, key in enumerate(keys) if key not in cache]
+    args = [(groups[i][1], k, method, grid_size, seed) for i in todo]
+
+    with span("geo.cluster", sum(len(groups[i][1]) for i in todo)):
+        if workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_cluster_points, *zip(*args)))
+        else:
+            results = [_cluster_points(*arg) for arg in args]
+
+    for i, result in zip(todo, results):
+        cache[keys[i]] = result
+    if cache_file is not None and len(todo) > 0:
+        # only results of current data are kept, so cache doesn't grow with every change
+        _save_pickle(cache_file, {key: cache[key] for key in keys})
+
+    names = []
+    centers = []
+    counts = []
+    for (name, _), key in zip(groups, keys):
+        group_centers, group_counts = cache[key]
+        names += [name] * len(group_counts)
+        centers.append(group_centers)
+        counts.append(group_counts)
+    centers = np.concatenate(centers) if centers else np.empty([0, 2])
+    counts = np.concatenate(counts) if counts else np.empty([0], dtype=np.int64)
+
+    df_centers = pd.DataFrame({'region': names, 'counts': counts})
+    return geopandas.GeoDataFrame(df_centers, geometry=geopandas.points_from_xy(centers[:, 0], centers[:, 1]),
+                                  crs=gdf.crs)
+
+
+@timed("geo.plot_cluster")
+def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False,
+                 k: int = 10, regions: Iterable[str] = (_reg,), mode: str = "points", log: bool = True,
+                 overlay: bool = True, **kwargs):
     """
     Draws graph with accident clusters
 
     :param gdf: data source
     :param fig_location: file to save to
     :param show_figure: show figure on screen
+    :param k: number of clusters
+    :param regions: regions to draw. If its None, all regions are drawn
+    :param mode: points to draw every accident as marker, raster to draw density of accidents as one image
+    :param log: if true, raster colors are in log scale
+    :param overlay: if true, raster is drawn over basemap, otherwise under it
+    :param kwargs: other arguments of cluster_accidents
     """
-    gdf = gdf[gdf.region == _reg]
+    if mode not in _plot_modes:
+        raise ValueError(f"unknown plot mode {mode}, expected one of {_plot_modes}")
+
+    if regions is not None:
+        gdf = gdf[gdf.region.isin(regions)]
     fig, ax = plt.subplots(1, 1)
     fig.set_size_inches((12, 10))
 
-    clusters = KMeans(n_clusters=10).fit(np.array([gdf.geometry.x, gdf.geometry.y]).transpose())
-    _unique, counts = np.unique(clusters.labels_, return_counts=True)
-
-    df_centers = pd.DataFrame(clusters.cluster_centers_)
-    df_centers['counts'] = counts
-    df_centers['counts_size'] = counts / 10
-    gdf_centers = geopandas.GeoDataFrame(df_centers, geometry=geopandas.points_from_xy(df_centers[0], df_centers[1]), crs="EPSG:5514")
+    gdf_centers = cluster_accidents(gdf, k, regions, **kwargs)
+    gdf_centers['counts_size'] = gdf_centers['counts'] / 10
 
-    gdf.plot(ax=ax, markersize=2, color='grey', alpha=0.1)
-    gdf_centers.plot(ax=ax, column='counts', markersize='counts_size', alpha=0.5, legend=True)
+    if mode == "raster":
+        with span("geo.raster", len(gdf)):
+            points = _coordinates(gdf)
+            extent, cell = _raster_grid(points, ax)
+            counts = _density_raster(points, np.zeros([len(points)], dtype=np.int64), 1, extent, cell)
+        _draw_raster(ax, counts[0], extent, cell, 'Greys', log, overlay)
+    else:
+        gdf.plot(ax=ax, markersize=2, color='grey', alpha=0.1)
+    # centres stay over raster
+    gdf_centers.plot(ax=ax, column='counts', markersize='counts_size', alpha=0.5, legend=True, zorder=3)
 
     ax.set_axis_off()
     fig.set_tight_layout(True)
-    contextily.add_basemap(ax, source=_map_src, crs=gdf.crs.to_string())
+    with span("geo.basemap"):
+        contextily.add_basemap(ax, source=_map_src, crs=gdf.crs.to_string(), **_basemap_args(mode, overlay))
 
     _save_and_show(fig_location, show_figure)
 
 
 if __name__ == "__main__":
-    gdf = make_geo(pd.read_pickle("data/accidents.pkl.gz"))
+    gdf = make_geo(pd.read_pickle("data/accidents.pkl.gz"), "data/accidents.pkl.gz" + _projection_cache_suffix)
+    index = SpatialIndex.from_geo(gdf, "data/accidents.pkl.gz" + _index_cache_suffix)
     plot_geo(gdf, "geo1.png", True)
     plot_cluster(gdf, "geo2.png", True)
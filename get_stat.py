@@ -1,56 +1,119 @@
-from download import DataDownloader
-import matplotlib.pyplot as plt
+from download import Batch, DataDownloader
 import numpy as np
 import argparse
-from typing import Tuple, List
+from typing import Iterable, Tuple, List, Union
 import os
 import errno
 
+from instrument import span, timed
 
-def plot_stat(data_source: Tuple[List[str], List[np.ndarray]], fig_location=None, show_figure=False):
+
+# names of columns with region and date in data source
+_region_column = "Kraj"
+_date_column = "Datum nehody"
+# labels of bars higher than this part of the highest bar are drawn inside of bar
+_label_inside_ratio = 0.8
+
+
+def count_by_year(data_source: Tuple[List[str], List[np.ndarray]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Counts accidents of every region in every year
+
+    :param data_source: header and columns returned by DataDownloader.get_list, with region and date columns
+    :return: years present in data, region names and counts with shape (years, regions)
+    """
+    header, columns = data_source
+    regions = columns[header.index(_region_column)]
+    dates = np.asarray(columns[header.index(_date_column)], dtype='datetime64[D]')
+
+    # dictionary encoded regions already have codes
+    if hasattr(regions, 'codes'):
+        names, codes = np.asarray(regions.categories), np.asarray(regions.codes, dtype=np.int64)
+    else:
+        names, codes = np.unique(np.asarray(regions), return_inverse=True)
+
+    # years since 1970
+    years = dates.astype('datetime64[Y]').astype(np.int64)
+    if len(years) == 0:
+        return np.empty([0], dtype=np.int64), names, np.zeros([0, len(names)], dtype=np.int64)
+    first = years.min()
+    n_years = int(years.max() - first) + 1
+    counts = np.bincount((years - first) * len(names) + codes, minlength=n_years * len(names))
+    counts = counts.reshape(n_years, len(names))
+
+    # years without accidents are skipped
+    present = counts.sum(axis=1) > 0
+    return np.arange(first, first + n_years)[present] + 1970, names, counts[present]
+
+
+def count_by_year_batches(batches: Iterable[Batch]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Counts accidents of every region in every year, batch by batch, so only counts are kept in memory
+
+    :param batches: batches yielded by DataDownloader.iter_batches, with region and date columns
+    :return: years present in data, region names and counts with shape (years, regions)
+    """
+    totals = {}
+    for _region, _month, header, columns in batches:
+        years, names, counts = count_by_year((header, columns))
+        for i, year in enumerate(years):
+            for j, name in enumerate(names):
+                totals[(year, name)] = totals.get((year, name), 0) + counts[i, j]
+
+    years = np.array(sorted({year for year, _ in totals}), dtype=np.int64)
+    names = np.array(sorted({name for _, name in totals}))
+    counts = np.zeros([len(years), len(names)], dtype=np.int64)
+    for (year, name), count in totals.items():
+        counts[np.searchsorted(years, year), np.searchsorted(names, name)] = count
+    return years, names, counts
+
+
+@timed("get_stat.plot_stat")
+def plot_stat(data_source: Union[Tuple[List[str], List[np.ndarray]], Iterable[Batch]], fig_location=None,
+              show_figure=False):
     """Renders plot with basic stats about accidents
 
-    :param data_source source of data
+    :param data_source source of data, header and columns from DataDownloader.get_list
+        or batches from DataDownloader.iter_batches
 
     :key fig_location: location to save file to
     :key show_figure: show figure
     """
-    fig, ax = plt.subplots(5, sharey=True)
+    # matplotlib is imported only when plot is drawn, so loading of data starts faster
+    import matplotlib.pyplot as plt
 
-    fig.set_size_inches((8, 10))
-    fig.suptitle("Počet nehod podle kraje za rok")
+    if isinstance(data_source, tuple):
+        years, names, counts = count_by_year(data_source)
+    else:
+        years, names, counts = count_by_year_batches(data_source)
 
-    graph_data = {str(x): {} for x in range(2016, 2021)}
+    fig, ax = plt.subplots(max(len(years), 1), sharey=True, squeeze=False)
+    ax = ax[:, 0]
 
-    for i in range(data_source[1][0].size):
-        reg = data_source[1][0][i]
-        date = data_source[1][4][i]
-        year = np.datetime_as_string(date, unit='Y')
+    fig.set_size_inches((8, 2 * max(len(years), 1)))
+    fig.suptitle("Počet nehod podle kraje za rok")
 
-        if reg not in graph_data[year]:
-            graph_data[year][reg] = 1
-        else:
-            graph_data[year][reg] += 1
+    threshold = counts.max() * _label_inside_ratio if counts.size > 0 else 0
 
-    for i, x in enumerate(range(2016, 2021)):
-        if i == 2:
+    for i, x in enumerate(years):
+        if i == len(years) // 2:
             ax[i].set(ylabel="počet nehod", xlabel="kraj", title=f"{x}")
         else:
             ax[i].set(xlabel="kraj", title=f"{x}")
-        keys = graph_data[str(x)].keys()
-        crashes = graph_data[str(x)].values()
         ax[i].grid(axis='y')
-        if x != 2020:
+        if i != len(years) - 1:
             ax[i].get_xaxis().set_visible(False)
 
-        crashes_sorted = sorted(crashes, reverse=True)
-        number = [crashes_sorted.index(x) + 1 for i, x in enumerate(crashes)]
+        # only regions with accidents in that year are drawn
+        present = counts[i] > 0
+        keys = names[present]
+        crashes = counts[i][present]
+        # same counts get the same rank
+        number = (crashes[None, :] > crashes[:, None]).sum(axis=1) + 1
 
         bar = ax[i].bar(keys, crashes)
 
         for bar_i, rect in enumerate(bar):
             height = rect.get_height()
-            if height > 20000:
+            if height > threshold:
                 ax[i].annotate('{}'.format(number[bar_i]),
                                xy=(rect.get_x() + rect.get_width() / 2, height),
                                xytext=(0, -3),
@@ -73,7 +136,8 @@ def plot_stat(data_source: Tuple[List[str], List[np.ndarray]], fig_location=None
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
-        plt.savefig(fig_location, dpi=200)
+        with span("savefig"):
+            plt.savefig(fig_location, dpi=200)
 
     if show_figure:
         plt.show()
@@ -83,8 +147,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--fig_location')
     parser.add_argument('--show_figure', default=False, action="store_true")
+    parser.add_argument('--offline', default=False, action="store_true",
+                        help="only use cached data and downloaded zips, never connect to server")
+    parser.add_argument('--batch_rows', type=int,
+                        help="count accidents in batches of this many rows instead of loading all at once")
     args = parser.parse_args()
 
-    data_source = DataDownloader().get_list(
-        ['PHA', 'STC', 'JHC', 'PLK', 'KVK', 'ULK', 'LBK', 'HKK', 'PAK', 'OLK', 'MSK', 'JHM', 'ZLK', 'VYS'])
-    plot_stat(data_source, show_figure=args.show_figure, fig_location=args.fig_location)
+    regions = ['PHA', 'STC', 'JHC', 'PLK', 'KVK', 'ULK', 'LBK', 'HKK', 'PAK', 'OLK', 'MSK', 'JHM', 'ZLK', 'VYS']
+    if args.batch_rows is not None:
+        # batches are counted while streaming, so only one of them is in memory
+        data_source = DataDownloader().iter_batches(regions, args.batch_rows, columns=[_region_column, _date_column],
+                                                     offline=args.offline)
+    else:
+        data_source = DataDownloader().get_list(regions, columns=[_region_column, _date_column], offline=args.offline)
+    # without figure location or window, there is nothing to draw
+    if args.fig_location is not None or args.show_figure:
+        plot_stat(data_source, show_figure=args.show_figure, fig_location=args.fig_location)
@@ -0,0 +1,237 @@
+import atexit
+import functools
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, memory is not measured there
+    resource = None
+
+# environment variable with path of report, setting it enables instrumentation
+_env_var = "IZV_PROFILE"
+# environment variable with pid of process which writes the report, other processes are its workers
+_owner_var = "IZV_PROFILE_OWNER"
+# records of worker processes are written next to report and merged into it
+_worker_suffix = ".{}.worker.json"
+
+_enabled = False
+_report = None
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    """Span used when instrumentation is disabled, does nothing"""
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def _peak_rss() -> int:
+    """Returns peak resident memory of process in bytes, or 0 if it can't be measured"""
+    if resource is None:
+        return 0
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Span:
+    """Measures wall time, cpu time and peak memory growth of code block"""
+    def __init__(self, name: str, rows: int = None):
+        """
+        :param name: name of span
+        :param rows: number of processed rows, can be set later inside the block
+        """
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+        self._path = ";".join(stack)
+        self._start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._rss = _peak_rss()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record = {
+            "name": self.name,
+            "path": self._path,
+            "start": self._start,
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "peak_memory_delta": _peak_rss() - self._rss,
+            "rows": self.rows,
+            "pid": os.getpid(),
+            "error": exc_type.__name__ if exc_type is not None else None,
+        }
+        _local.stack.pop()
+        with _lock:
+            _records.append(record)
+        return False
+
+
+def span(name: str, rows: int = None):
+    """Returns context manager measuring code block, it does nothing when instrumentation is disabled
+
+    :param name: name of span
+    :param rows: number of processed rows, can be set later as attribute of returned span
+    """
+    if not _enabled:
+        return _null_span
+    return _Span(name, rows)
+
+
+def timed(name: str = None) -> Callable:
+    """Decorator measuring every call of function as span
+
+    :param name: name of span. If its None, qualified name of function is used
+    """
+    def decorator(fn: Callable) -> Callable:
+        span_name = name if name is not None else f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _write_worker_records():
+    """Writes spans of worker process next to report, where the owner of report merges them"""
+    filename = _report + _worker_suffix.format(os.getpid())
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(records(), f)
+    os.replace(tmp_filename, filename)
+
+
+def _register_worker():
+    """Makes current process a worker, its spans are handed to the owner of report at its exit"""
+    # multiprocessing runs finalizers also in forked workers, which skip atexit
+    multiprocessing.util.Finalize(None, _write_worker_records, exitpriority=0)
+
+
+class _ForkHook:
+    """Object registered in multiprocessing, its hook runs in every forked worker"""
+
+
+_fork_hook = _ForkHook()
+
+
+def _after_fork(_hook: _ForkHook):
+    """Forked worker keeps measuring, but only its own spans are handed over"""
+    global _lock
+    if not _enabled or _report is None:
+        return
+    _lock = threading.Lock()
+    _records.clear()
+    _register_worker()
+
+
+def enable(report: str = None):
+    """Enables instrumentation
+
+    First process with report writes it at exit of program. Its worker processes, spawned or forked,
+    hand their spans over to it, so report covers all of them.
+
+    :param report: file to write report to at exit of program. If its None, report is only kept in memory
+    """
+    global _enabled, _report
+    _enabled = True
+    if report is None:
+        return
+
+    _report = os.path.abspath(report)
+    owner = os.environ.get(_owner_var)
+    if owner is not None and owner != str(os.getpid()):
+        _register_worker()
+        return
+    # spawned workers inherit environment, so they know where to hand over spans
+    os.environ[_env_var] = _report
+    os.environ[_owner_var] = str(os.getpid())
+    atexit.register(write_report, _report)
+
+
+def disable():
+    """Disables instrumentation, already measured spans are kept"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Returns true if instrumentation is enabled"""
+    return _enabled
+
+
+def records() -> List[Dict]:
+    """Returns all measured spans, in order of their end"""
+    with _lock:
+        return list(_records)
+
+
+def reset():
+    """Removes all measured spans"""
+    with _lock:
+        _records.clear()
+
+
+def write_report(filename: str):
+    """Writes measured spans into file
+
+    Files ending with .folded get collapsed stacks with self wall time in microseconds, usable by flame graph tools.
+    Other files get json with all measured values.
+
+    Spans of worker processes of this report are merged in.
+
+    :param filename: file to write to
+    """
+    spans = records()
+    for worker_filename in sorted(glob.glob(glob.escape(os.path.abspath(filename)) + _worker_suffix.format('*'))):
+        with open(worker_filename, 'r', encoding='utf-8') as f:
+            spans += json.load(f)
+        os.remove(worker_filename)
+
+    if filename.endswith(".folded"):
+        # time of children is subtracted, so every stack has only its own time
+        self_time = {}
+        for record in spans:
+            self_time[record["path"]] = self_time.get(record["path"], 0) + record["wall"]
+            parent = record["path"].rpartition(";")[0]
+            if parent != "":
+                self_time[parent] = self_time.get(parent, 0) - record["wall"]
+        with open(filename, 'w', encoding='utf-8') as f:
+            for path, wall in self_time.items():
+                f.write(f"{path} {max(int(wall * 1e6), 0)}\n")
+    else:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({"spans": spans}, f, indent=2)
+
+
+# finalizers of parent are dropped in forked workers, so worker registers itself after fork
+multiprocessing.util.register_after_fork(_fork_hook, _after_fork)
+
+if os.environ.get(_env_var):
+    enable(os.environ[_env_var])
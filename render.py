@@ -0,0 +1,236 @@
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+# name of manifest with fingerprints of rendered figures
+_manifest_name = "render_manifest.json"
+
+# data loaded in this process, shared by jobs with same loader
+_loaded = dict()
+
+
+class FigureJob:
+    """Describes one figure to render"""
+    def __init__(self, plot: Callable, fig_location: str, load: Callable, load_args: Tuple = (), inputs: List[str] = None,
+                 params: Dict = None, deps: List = None):
+        """
+        :param plot: module level plot function, called as plot(data, fig_location=..., show_figure=False, **params)
+        :param fig_location: file to save figure to
+        :param load: module level function returning data for plot
+        :param load_args: arguments of load function
+        :param inputs: files and folders the data is loaded from, their changes cause new render
+        :param params: additional arguments of plot function
+        :param deps: modules or functions the load function calls, changes of their source files cause new render
+        """
+        self.plot = plot
+        self.fig_location = fig_location
+        self.load = load
+        self.load_args = tuple(load_args)
+        self.inputs = inputs if inputs is not None else []
+        self.params = params if params is not None else {}
+        self.deps = deps if deps is not None else []
+
+    def fingerprint(self) -> str:
+        """Returns hash of input data, code of plot function and parameters"""
+        # code of plot and load functions and of modules the loader calls is input too,
+        # timed functions are unwrapped so file of their definition is used
+        code = [self.plot, self.load] + list(self.deps)
+        paths = list(self.inputs) + sorted(set(inspect.getfile(inspect.unwrap(x)) for x in code))
+
+        stats = []
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    stats.append(_file_stat(os.path.join(path, name)))
+            else:
+                stats.append(_file_stat(path))
+
+        key = {
+            "plot": f"{self.plot.__module__}.{self.plot.__qualname__}",
+            "load": f"{self.load.__module__}.{self.load.__qualname__}",
+            "load_args": repr(self.load_args),
+            "params": repr(sorted(self.params.items())),
+            "inputs": stats,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _file_stat(path: str) -> List:
+    """Returns name, size and modification time of file, or only name if file does not exist
+
+    :param path: file to check
+    """
+    if not os.path.isfile(path):
+        return [path]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def _init_worker():
+    """Switches worker process to non-interactive backend, before any figure is created"""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _render(job: FigureJob) -> str:
+    """Renders one figure, used by worker processes
+
+    :param job: figure to render
+    :return: location of rendered figure
+    """
+    import matplotlib.pyplot as plt
+
+    key = (job.load, job.load_args)
+    if key not in _loaded:
+        _loaded[key] = job.load(*job.load_args)
+
+    job.plot(_loaded[key], fig_location=job.fig_location, show_figure=False, **job.params)
+    plt.close('all')
+    return job.fig_location
+
+
+def render_batch(jobs: List[FigureJob], manifest: str = _manifest_name, workers: int = None,
+                 force: bool = False) -> List[str]:
+    """Renders figures in process pool, figures with unchanged fingerprint are skipped
+
+    :param jobs: figures to render
+    :param manifest: file with fingerprints of already rendered figures
+    :param workers: number of processes. If its None, uses all cpus
+    :param force: render all figures, even unchanged ones
+    :return: locations of rendered figures
+    """
+    try:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            rendered = json.load(f)
+    except FileNotFoundError:
+        rendered = {}
+
+    to_render = []
+    fingerprints = {}
+    for job in jobs:
+        fingerprints[job.fig_location] = job.fingerprint()
+        unchanged = rendered.get(job.fig_location) == fingerprints[job.fig_location]
+        if force or not unchanged or not os.path.isfile(job.fig_location):
+            to_render.append(job)
+
+    if len(to_render) == 0:
+        return []
+
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(min(workers, len(to_render)), 1)
+
+    for job in to_render:
+        folder_path, _ = os.path.split(job.fig_location)
+        if folder_path != '':
+            os.makedirs(folder_path, exist_ok=True)
+
+    done = []
+    # spawned workers don't inherit already selected backend
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+        try:
+            for fig_location in executor.map(_render, to_render):
+                rendered[fig_location] = fingerprints[fig_location]
+                done.append(fig_location)
+        finally:
+            # keep fingerprints of figures finished before failure
+            folder_path, _ = os.path.split(manifest)
+            if folder_path != '':
+                os.makedirs(folder_path, exist_ok=True)
+            with open(manifest, 'w', encoding='utf-8') as f:
+                json.dump(rendered, f, indent=2)
+
+    return done
+
+
+def load_frame(filename: str):
+    """Returns DataFrame made by analysis.get_dataframe
+
+    :param filename: path to file with input data
+    """
+    import analysis
+    return analysis.get_dataframe(filename)
+
+
+def load_cube(filename: str):
+    """Returns cube made by analysis.make_cube
+
+    :param filename: path to file with input data
+    """
+    import analysis
+    return analysis.make_cube(analysis.get_dataframe(filename))
+
+
+def load_geo(filename: str):
+    """Returns GeoDataFrame made by geo.make_geo
+
+    :param filename: path to file with input data
+    """
+    import pandas as pd
+    import geo
+    return geo.make_geo(pd.read_pickle(filename), filename + geo._projection_cache_suffix)
+
+
+def load_list(folder: str):
+    """Returns regions and dates of all accidents from DataDownloader
+
+    :param folder: folder with zips and cache files
+    """
+    from download import DataDownloader
+    import get_stat
+    # plot_stat only needs region and date
+    return DataDownloader(folder=folder).get_list(columns=[get_stat._region_column, get_stat._date_column])
+
+
+def default_jobs(data_folder: str = "data", output: str = "figures") -> List[FigureJob]:
+    """Returns jobs for all figures of the report
+
+    :param data_folder: folder with input data
+    :param output: folder to save figures to
+    """
+    import analysis
+    import doc
+    import download
+    import geo
+    import get_stat
+
+    accidents = os.path.join(data_folder, "accidents.pkl.gz")
+    # cache files in data folder change on load, so only zips are inputs
+    zips = [os.path.join(data_folder, name) for name in sorted(os.listdir(data_folder)) if name.endswith('.zip')] \
+        if os.path.isdir(data_folder) else []
+    return [
+        FigureJob(analysis.plot_conseq, os.path.join(output, "conseq.png"), load_cube, (accidents,), [accidents],
+                  deps=[analysis]),
+        FigureJob(analysis.plot_damage, os.path.join(output, "damage.png"), load_cube, (accidents,), [accidents],
+                  deps=[analysis]),
+        FigureJob(analysis.plot_surface, os.path.join(output, "surface.png"), load_cube, (accidents,), [accidents],
+                  deps=[analysis]),
+        FigureJob(geo.plot_geo, os.path.join(output, "geo1.png"), load_geo, (accidents,), [accidents], deps=[geo]),
+        FigureJob(geo.plot_cluster, os.path.join(output, "geo2.png"), load_geo, (accidents,), [accidents], deps=[geo]),
+        FigureJob(doc.plot_visibility, os.path.join(output, "fig.png"), load_frame, (accidents,), [accidents],
+                  deps=[analysis]),
+        FigureJob(get_stat.plot_stat, os.path.join(output, "stat.png"), load_list, (data_folder,), zips,
+                  deps=[download, get_stat]),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_folder', default="data")
+    parser.add_argument('--output', default="figures")
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--force', default=False, action="store_true")
+    args = parser.parse_args()
+
+    rendered_figures = render_batch(default_jobs(args.data_folder, args.output),
+                                    manifest=os.path.join(args.output, _manifest_name),
+                                    workers=args.workers, force=args.force)
+    print(f"Vykresleno {len(rendered_figures)} grafů")
+    for figure in rendered_figures:
+        print(figure)